@@ -0,0 +1,87 @@
+# _precise_sleep.py
+# High resolution waits used by the recording functions in device_test.py
+
+import sys
+import time
+import threading
+
+# On Linux, wait on a timerfd armed with an absolute CLOCK_MONOTONIC deadline.
+# time.monotonic_ns() reads the same clock there, so deadlines can be passed
+# straight through. Everywhere else fall back to time.sleep().
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        import os
+        import ctypes
+        import ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        class _itimerspec(ctypes.Structure):
+            _fields_ = [("it_interval", _timespec), ("it_value", _timespec)]
+
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _libc.timerfd_create.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc.timerfd_settime.argtypes = [
+            ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(_itimerspec), ctypes.POINTER(_itimerspec),
+        ]
+    except (ImportError, OSError, AttributeError):
+        _libc = None
+
+CLOCK_MONOTONIC = 1
+TFD_CLOEXEC = 0o2000000
+TFD_TIMER_ABSTIME = 1
+
+# Timer wake-ups can be late by up to a few hundred microseconds, so the
+# last stretch before a deadline is spent spinning on the clock instead
+SPIN_NS = 500_000
+
+# One timerfd per thread, created on first use; threads that use
+# sleep_until() should call close_timer() before they exit
+_local = threading.local()
+
+def _timerfd():
+    """Return this thread's timerfd, creating it if needed, or None if it can't be created"""
+    fd = getattr(_local, "fd", None)
+    if fd is None:
+        fd = _libc.timerfd_create(CLOCK_MONOTONIC, TFD_CLOEXEC)
+        if fd < 0:
+            return None
+        _local.fd = fd
+    return fd
+
+def close_timer():
+    """Close this thread's timerfd, if it has one"""
+    fd = getattr(_local, "fd", None)
+    if fd is not None:
+        _local.fd = None
+        os.close(fd)
+
+def sleep_until(deadline_ns):
+    """
+    Block until time.monotonic_ns() reaches the given deadline
+
+    Args:
+        deadline_ns (int): Absolute deadline on the time.monotonic_ns() clock
+    """
+    wake_ns = deadline_ns - SPIN_NS
+    remaining = wake_ns - time.monotonic_ns()
+    if remaining > 0:
+        slept = False
+        if _libc is not None:
+            spec = _itimerspec()
+            spec.it_value.tv_sec, spec.it_value.tv_nsec = divmod(wake_ns, 1_000_000_000)
+            fd = _timerfd()
+            if fd is not None and _libc.timerfd_settime(fd, TFD_TIMER_ABSTIME, ctypes.byref(spec), None) == 0:
+                # Blocks until the timer expires
+                os.read(fd, 8)
+                slept = True
+        if not slept:
+            time.sleep(remaining / 1e9)
+
+    # Spin for the remainder; this is bounded by SPIN_NS per call
+    monotonic_ns = time.monotonic_ns
+    while monotonic_ns() < deadline_ns:
+        pass
@@ -12,22 +12,175 @@ import general
 import device
 import time
 import sys
+import os
+import array
+import operator
+import functools
+import queue
+import threading
+
+# The mixer module is not available in every FL Studio version
+try:
+    import mixer
+    _HAVE_MIXER = True
+except ImportError:
+    mixer = None
+    _HAVE_MIXER = False
+
+from _precise_sleep import sleep_until, close_timer
+
+# Set to True to print progress from the MIDI callbacks
+DEBUG = False
+
+class _State:
+    """Flags shared with the terminal thread"""
+    __slots__ = ("running",)
+
+    def __init__(self):
+        self.running = True
+
+_state = _State()
 
 # Global variables
-running = True
 command_history = []
 current_pattern = 0
 current_channel = 0
 terminal_active = False
 
+# Tempo protocol: NOTE_TEMPO_START, the number of digits, the 7-bit digits
+# (MSB first), then NOTE_TEMPO_END. Digits may themselves be 72 or 73, so
+# the markers only count once all the announced digits have arrived
 collecting_tempo_notes = False
 tempo_note_array = []
+tempo_digit_count = None  # Digits announced for the tempo being received
 NOTE_TEMPO_START = 72  # C4 starts tempo note collection
 NOTE_TEMPO_END = 73    # C#4 ends collection and applies tempo change
 
 channel_to_edit = 0
 step_to_edit = 0
 
+# Special MIDI commands used by process_received_midi
+DECIMAL_MARKER = 100   # Indicates next value is a decimal part
+LENGTH_MARKER = 101    # Next value affects length
+POSITION_MARKER = 102  # Next value affects position
+
+# Pulses per quarter note of the project. Read through _ppq(), which only
+# asks FL Studio again after OnRefresh reports a project-level change
+PPQ = 96
+_ppq_stale = True
+
+def _ppq():
+    """Return the project's PPQ, re-reading it only when it may have changed"""
+    global PPQ, _ppq_stale
+    if _ppq_stale:
+        PPQ = general.getRecPPQ()
+        _ppq_stale = False
+    return PPQ
+
+# Note names ("C4", "C#4", "Db4", ...) to MIDI note numbers, with C4 = 60.
+# A name without an octave ("C#", "Db") means octave 4
+NOTE_TABLE = {}
+_SHARP_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+_FLAT_NAMES = ('C', 'DB', 'D', 'EB', 'E', 'F', 'GB', 'G', 'AB', 'A', 'BB', 'B')
+for _octave in range(-1, 10):
+    for _i in range(12):
+        _number = (_octave + 1) * 12 + _i
+        if _number > 127:
+            break
+        NOTE_TABLE[f"{_SHARP_NAMES[_i]}{_octave}"] = _number
+        NOTE_TABLE[f"{_FLAT_NAMES[_i]}{_octave}"] = _number
+        if _octave == 4:
+            NOTE_TABLE[_SHARP_NAMES[_i]] = _number
+            NOTE_TABLE[_FLAT_NAMES[_i]] = _number
+del _octave, _i, _number
+
+class NoteBuilder:
+    """State shared by the MIDI receive handlers, kept on one object"""
+    __slots__ = ('note', 'velocity', 'length_ticks', 'position_ticks',
+                 'decimal_state', 'decimal_value', 'decimal_target',
+                 'receiving', 'expected', 'received', 'data', 'notes', 'written')
+
+    def __init__(self):
+        # Marker state machine (see process_received_midi)
+        self.note = None
+        self.velocity = None
+        self.length_ticks = None    # Kept in ticks so no floats are built per event
+        self.position_ticks = None
+        self.decimal_state = 0
+        self.decimal_value = 0
+        self.decimal_target = None
+        
+        # Melody transfer state (see _handle_note_on)
+        self.receiving = False
+        self.expected = 0
+        self.received = 0
+        self.data = bytearray(6)  # Values of the note currently being received
+        self.notes = []           # Preallocated once the note count is known
+        self.written = 0
+
+BUILDER = NoteBuilder()
+
+# Output from the MIDI callbacks is queued and written by a background
+# thread, so the callback never waits on stdout
+LOG_Q = queue.SimpleQueue()
+log_thread_started = False
+
+def _log_worker():
+    """Write queued log messages to stdout"""
+    while True:
+        sys.stdout.write(LOG_Q.get() + '\n')
+
+def start_log_thread():
+    """Start the thread that drains LOG_Q"""
+    global log_thread_started
+    if not log_thread_started:
+        log_thread_started = True
+        thread = threading.Thread(target=_log_worker)
+        thread.daemon = True
+        thread.start()
+
+def log(msg):
+    """Queue a message for the log thread"""
+    LOG_Q.put_nowait(msg)
+
+# Received melodies and recording commands run on a worker thread, since
+# the recording functions sleep for as long as the notes play. Each item
+# on RECORD_Q is a (function, args) pair
+RECORD_Q = queue.SimpleQueue()
+record_thread_started = False
+
+def _record_worker():
+    """Run each job put on RECORD_Q, one at a time"""
+    while True:
+        fn, args = RECORD_Q.get()
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Error in {fn.__name__}: {e}")
+
+def run_in_background(fn, *args):
+    """
+    Queue a long-running call for the record worker thread
+    
+    Args:
+        fn: Function to call
+        *args: Arguments to call it with
+    """
+    RECORD_Q.put_nowait((fn, args))
+
+def start_record_thread():
+    """Start the thread that drains RECORD_Q"""
+    global record_thread_started
+    if not record_thread_started:
+        record_thread_started = True
+        thread = threading.Thread(target=_record_worker)
+        thread.daemon = True
+        thread.start()
+
+def _clamp(value, low, high):
+    """Limit value to the range [low, high]"""
+    return max(low, min(high, value))
+
 def midi_notes_to_int(midi_notes):
     """
     Convert an array of MIDI note values (7 bits each) into a single integer
@@ -43,29 +196,41 @@ def midi_notes_to_int(midi_notes):
     """
     result = 0
     for note in midi_notes:
-        # Ensure each value is within MIDI range (0-127)
-        note_value = min(127, max(0, note))
-        # Shift left by 7 bits (MIDI values use 7 bits) and combine
-        result = (result << 7) | note_value
+        # Shift left by 7 bits and mask the note to its 7 MIDI data bits
+        result = (result << 7) | (note & 0x7F)
     return result
 
 def OnInit():
     """Called when the script is loaded by FL Studio"""
+    _ppq()
     print("FL Studio Terminal Beat Builder initialized")
     print("Type 'help' for a list of commands")
     
+    start_log_thread()
+    start_record_thread()
     return
 
 def OnDeInit():
     """Called when the script is unloaded by FL Studio"""
-    global running
-    running = False  # Signal the terminal thread to exit
+    _state.running = False  # Signal the terminal thread to exit
     print("FL Studio Terminal Beat Builder deinitialized")
     return
 
+# Refreshes that only report changed values, sent continuously during
+# playback; none of them can change the PPQ
+_VALUE_REFRESH_FLAGS = midi.HW_Dirty_LEDs | midi.HW_Dirty_ControlValues | midi.HW_Dirty_RemoteLinkValues
+
 def OnRefresh(flags):
     """Called when FL Studio's state changes or when a refresh is needed"""
-    # Update terminal with current state if needed
+    global _ppq_stale
+    if flags & ~_VALUE_REFRESH_FLAGS:
+        _ppq_stale = True
+    
+    # Drop cached mixer state that FL Studio reports as changed
+    if flags & midi.HW_Dirty_Mixer_Sel:
+        _invalidate_mixer_cache()
+    elif flags & midi.HW_Dirty_Mixer_Controls:
+        _invalidate_mixer_cache(track=False)
     return
 
 def OnMidiIn(event):
@@ -73,6 +238,13 @@ def OnMidiIn(event):
     #print(f"MIDI In - Status: {event.status}, Data1: {event.data1}, Data2: {event.data2}")
     return
 
+# Use processRECEvent to set the tempo
+# REC_Tempo is the event ID for tempo
+# REC_Control | REC_UpdateControl flags ensure the value is set and the UI updates
+_REC_TEMPO = midi.REC_Tempo
+_REC_FLAGS = midi.REC_Control | midi.REC_UpdateControl
+_PROC_REC = general.processRECEvent
+
 def change_tempo(bpm):
     """
     Change the tempo in FL Studio to the specified BPM value
@@ -81,296 +253,456 @@ def change_tempo(bpm):
         bpm (float): The desired tempo in beats per minute
     """
     # FL Studio stores tempo as BPM * 1000
-    tempo_value = int(bpm * 1000)
-    
-    # Use processRECEvent to set the tempo
-    # REC_Tempo is the event ID for tempo
-    # REC_Control | REC_UpdateControl flags ensure the value is set and the UI updates
-    general.processRECEvent(
-        midi.REC_Tempo,
-        tempo_value,
-        midi.REC_Control | midi.REC_UpdateControl
-    )
+    _PROC_REC(_REC_TEMPO, int(bpm * 1000), _REC_FLAGS)
 
-def process_received_midi(note, velocity):
+def _handle_decimal_marker(note, velocity):
+    """Next value will be the decimal part of the current target"""
+    BUILDER.decimal_state = 1
+    return False
 
-    global current_note, current_velocity, current_length, current_position
-    global decimal_state, decimal_value, decimal_target
-    
-    # Special MIDI commands
-    DECIMAL_MARKER = 100   # Indicates next value is a decimal part
-    LENGTH_MARKER = 101    # Next value affects length
-    POSITION_MARKER = 102  # Next value affects position
-    
-    # Process based on message type
-    if note == DECIMAL_MARKER:
-        # Next value will be a decimal
-        decimal_state = 1
-        return False
-        
-    elif note == LENGTH_MARKER:
-        # Next value affects length
-        decimal_target = "length"
-        decimal_state = 0
-        decimal_value = 0
-        return False
-        
-    elif note == POSITION_MARKER:
-        # Next value affects position
-        decimal_target = "position"
-        decimal_state = 0
-        decimal_value = 0
-        return False
-        
-    elif decimal_state == 1:
+def _handle_length_marker(note, velocity):
+    """Next value affects the note length"""
+    BUILDER.decimal_target = "length"
+    BUILDER.decimal_state = 0
+    BUILDER.decimal_value = 0
+    return False
+
+def _handle_position_marker(note, velocity):
+    """Next value affects the note position"""
+    BUILDER.decimal_target = "position"
+    BUILDER.decimal_state = 0
+    BUILDER.decimal_value = 0
+    return False
+
+def _handle_data_byte(note, velocity):
+    """Handle a value that is not one of the special marker notes"""
+    ppq = _ppq()
+    if BUILDER.decimal_state == 1:
         # This is a decimal part value
-        decimal_value = note / 10.0  # Convert to decimal (0-9 becomes 0.0-0.9)
+        BUILDER.decimal_value = (note * ppq) // 10  # Tenths of a beat (0-9) in ticks
         
         # Apply to the correct parameter
-        if decimal_target == "length":
-            current_length = (current_length or 0) + decimal_value
-            print(f"Set length decimal: {current_length:.2f}")
-        elif decimal_target == "position":
-            current_position = (current_position or 0) + decimal_value
-            print(f"Set position decimal: {current_position:.2f}")
+        if BUILDER.decimal_target == "length":
+            BUILDER.length_ticks = (BUILDER.length_ticks or 0) + BUILDER.decimal_value
+            if DEBUG:
+                log(f"Set length decimal: {BUILDER.length_ticks} ticks")
+        elif BUILDER.decimal_target == "position":
+            BUILDER.position_ticks = (BUILDER.position_ticks or 0) + BUILDER.decimal_value
+            if DEBUG:
+                log(f"Set position decimal: {BUILDER.position_ticks} ticks")
             
-        decimal_state = 0
+        BUILDER.decimal_state = 0
         return False
         
-    elif decimal_target is not None:
+    elif BUILDER.decimal_target is not None:
         # This is a whole number part for a specific parameter
-        if decimal_target == "length":
-            current_length = float(note)
-            print(f"Set length whole: {current_length:.2f}")
-        elif decimal_target == "position":
-            current_position = float(note)
-            print(f"Set position whole: {current_position:.2f}")
+        if BUILDER.decimal_target == "length":
+            BUILDER.length_ticks = note * ppq
+            if DEBUG:
+                log(f"Set length whole: {BUILDER.length_ticks} ticks")
+        elif BUILDER.decimal_target == "position":
+            BUILDER.position_ticks = note * ppq
+            if DEBUG:
+                log(f"Set position whole: {BUILDER.position_ticks} ticks")
         return False
         
     else:
         # This is a note value and velocity
         # Check if we have a complete previous note to add
-        add_note = (current_note is not None and 
-                   current_velocity is not None and 
-                   current_length is not None and 
-                   current_position is not None)
+        add_note = (BUILDER.note is not None and 
+                   BUILDER.velocity is not None and 
+                   BUILDER.length_ticks is not None and 
+                   BUILDER.position_ticks is not None)
         
         # Start a new note
-        current_note = note
-        current_velocity = velocity
+        BUILDER.note = note
+        BUILDER.velocity = velocity
         # Use default values if not specified
-        if current_length is None:
-            current_length = 1.0
-        if current_position is None:
-            current_position = 0.0
-        print(f"Started new note: {current_note}, velocity: {current_velocity}")
+        if BUILDER.length_ticks is None:
+            BUILDER.length_ticks = ppq  # One beat
+        if BUILDER.position_ticks is None:
+            BUILDER.position_ticks = 0
+        if DEBUG:
+            log(f"Started new note: {BUILDER.note}, velocity: {BUILDER.velocity}")
         
         return add_note
 
+# Marker notes dispatch straight to their handler, everything else is data
+MARKER_HANDLERS = {
+    DECIMAL_MARKER: _handle_decimal_marker,
+    LENGTH_MARKER: _handle_length_marker,
+    POSITION_MARKER: _handle_position_marker,
+}
 
-def OnMidiMsg(event, timestamp=0):
-    """Called when a processed MIDI message is received"""
-    
-    global receiving_mode, message_count, messages_received
-    global current_note, current_velocity, current_length, current_position
-    global decimal_state, decimal_target, midi_notes_array
-    
-    if 'receiving_mode' not in globals():
-        global receiving_mode
-        receiving_mode = False
-    
-    if 'note_count' not in globals():
-        global note_count
-        note_count = 0
-    
-    if 'values_received' not in globals():
-        global values_received
-        values_received = 0
+def process_received_midi(note, velocity):
+    """Feed one received note into the marker state machine"""
+    return MARKER_HANDLERS.get(note, _handle_data_byte)(note, velocity)
+
+
+def _ignore_event(event):
+    """Called for MIDI messages this script does not handle"""
+    return
+
+def _finish_receiving(builder):
+    """Stop receiving and hand the collected notes to the record thread"""
+    if DEBUG:
+        log(f"Received all {builder.written} notes or termination signal")
+    builder.receiving = False
+    # Drop unused slots if the transfer was terminated early
+    del builder.notes[builder.written:]
+    
+    # Only process if we have actual notes
+    if builder.notes:
+        if DEBUG:
+            # Print all collected notes
+            log(f"Collected {len(builder.notes)} notes:")
+            for i, (note, vel, length, pos) in enumerate(builder.notes):
+                log(f"  Note {i+1}: note={note}, velocity={vel}, length={length:.1f}, position={pos:.1f}")
+            
+            log("\nFinal array:")
+            log(str(builder.notes))
+        
+        # Hand the notes to the record thread so the callback returns
+        run_in_background(record_notes_batch, builder.notes)
+
+def _receive_value(note_value, builder=BUILDER):
+    """
+    Feed one value of the melody transfer protocol into the receiver
     
-    if 'midi_data' not in globals():
-        global midi_data
-        midi_data = []
+    Args:
+        note_value (int): The note number of a received Note On (0-127)
+        
+    Returns:
+        bool: True if the value should be marked as handled
+    """
+    # Toggle receiving mode with note 0
+    if note_value == 0 and not builder.receiving:
+        builder.receiving = True
+        if DEBUG:
+            log("Started receiving MIDI notes")
+        builder.expected = 0
+        builder.received = 0
+        builder.notes = []
+        builder.written = 0
+        return True
+    
+    # Only process further messages if in receiving mode
+    if not builder.receiving:
+        return False
     
-    if 'midi_notes_array' not in globals():
-        global midi_notes_array
-        midi_notes_array = []
+    # Second message is the note count
+    if builder.expected == 0:
+        builder.expected = note_value
+        # Allocate a slot per note up front instead of growing the list
+        builder.notes = [None] * note_value
+        if DEBUG:
+            log(f"Expecting {builder.expected} notes")
+        return True
+    
+    # All subsequent messages are MIDI values (6 per note)
+    slot = builder.received % 6
+    builder.data[slot] = note_value
+    builder.received += 1
+    
+    # Process completed notes (every 6 values)
+    if slot == 5:
+        # Process the note that just completed
+        (note, velocity, length_whole, length_decimal,
+         position_whole, position_decimal) = builder.data
+        
+        # A position decimal is 0-9, so 127 here can only be the end marker
+        if position_decimal == 127:
+            _finish_receiving(builder)
+            return True
+        
+        # Calculate full values
+        length = length_whole + (length_decimal / 10.0)
+        position = position_whole + (position_decimal / 10.0)
+        
+        # Add to notes array
+        builder.notes[builder.written] = (note, velocity, length, position)
+        builder.written += 1
+        if DEBUG:
+            log(f"Added note: note={note}, velocity={velocity}, length={length:.1f}, position={position:.1f}")
+            log(f"Current array size: {builder.written}")
+
+        if builder.written >= builder.expected:
+            _finish_receiving(builder)
+            return True
+
+    return False
+
+def _start_tempo(note):
+    """Note 72: start collecting the notes of a tempo value"""
+    global collecting_tempo_notes, tempo_note_array, tempo_digit_count
+    collecting_tempo_notes = True
+    tempo_note_array = []
+    tempo_digit_count = None
+    if DEBUG:
+        log("Started collecting notes for tempo change")
+
+def _end_tempo(note):
+    """Note 73: apply the collected tempo value and stop collecting"""
+    global collecting_tempo_notes, tempo_note_array, tempo_digit_count
+    if collecting_tempo_notes and tempo_note_array:
+        bpm = change_tempo_from_notes(tempo_note_array)
+        if DEBUG:
+            log(f"Tempo changed to {bpm} BPM from collected notes: {tempo_note_array}")
+    elif DEBUG:
+        log("No tempo notes collected, tempo unchanged")
+    collecting_tempo_notes = False
+    tempo_note_array = []
+    tempo_digit_count = None
+
+def _collect_tempo_note(note):
+    """
+    Take a note as the digit count or the next digit of the tempo being
+    received
     
-    # Only process Note On messages with velocity > 0
-    if event.status >= midi.MIDI_NOTEON and event.status < midi.MIDI_NOTEON + 16 and event.data2 > 0:
-        note_value = event.data1
+    Args:
+        note (int): The note number
         
-        # Toggle receiving mode with note 0
-        if note_value == 0 and not receiving_mode:
-            receiving_mode = True
-            print("Started receiving MIDI notes")
-            midi_data = []
-            note_count = 0
-            values_received = 0
-            midi_notes_array = []
+    Returns:
+        bool: False once every announced digit is in, so the note can be
+            read as a marker
+    """
+    global tempo_digit_count
+    if tempo_digit_count is None:
+        tempo_digit_count = note
+    elif len(tempo_note_array) < tempo_digit_count:
+        tempo_note_array.append(note)
+    else:
+        return False
+    if DEBUG:
+        log(f"Added note {note} to tempo collection, current array: {tempo_note_array}")
+    return True
+
+# Note On numbers with their own meaning outside a melody transfer
+_NOTE_ON_DISPATCH = {
+    NOTE_TEMPO_START: _start_tempo,
+    NOTE_TEMPO_END: _end_tempo,
+}
+
+def _handle_note_on(event):
+    """Handle a Note On message from the tempo or melody transfer protocols"""
+    # Note On with velocity 0 is a Note Off
+    if not event.data2:
+        return
+    note = event.data1
+    
+    # During a melody transfer every note is data, so only look at the
+    # tempo notes outside one
+    if not BUILDER.receiving:
+        if collecting_tempo_notes and _collect_tempo_note(note):
             event.handled = True
             return
-        
-        # Only process further messages if in receiving mode
-        if not receiving_mode:
+        handler = _NOTE_ON_DISPATCH.get(note)
+        if handler is not None:
+            handler(note)
+            event.handled = True
             return
-        
-        # Second message is the note count
-        if note_count == 0:
-            note_count = note_value
-            print(f"Expecting {note_count} notes")
+        if collecting_tempo_notes:
+            # Extra notes after the last digit are dropped
             event.handled = True
             return
-        
-        # All subsequent messages are MIDI values (6 per note)
-        midi_data.append(note_value)
-        values_received += 1
-        
-        # Process completed notes (every 6 values)
-        if len(midi_data) >= 6 and len(midi_data) % 6 == 0:
-            # Process the last complete note
-            i = len(midi_data) - 6
-            note = midi_data[i]
-            velocity = midi_data[i+1]
-            length_whole = midi_data[i+2]
-            length_decimal = midi_data[i+3]
-            position_whole = midi_data[i+4]
-            position_decimal = midi_data[i+5]
-            
-            # Calculate full values
-            length = length_whole + (length_decimal / 10.0)
-            position = position_whole + (position_decimal / 10.0)
-            
-            # Add to notes array
-            midi_notes_array.append((note, velocity, length, position))
-            print(f"Added note: note={note}, velocity={velocity}, length={length:.1f}, position={position:.1f}")
-            print(f"Current array size: {len(midi_notes_array)}")
-
-            if len(midi_notes_array) >= note_count or note_value == 127:
-                print(f"Received all {len(midi_notes_array)} notes or termination signal")
-                receiving_mode = False
-                
-                # Only process if we have actual notes
-                if midi_notes_array:
-                    # Print all collected notes
-                    print(f"Collected {len(midi_notes_array)} notes:")
-                    for i, (note, vel, length, pos) in enumerate(midi_notes_array):
-                        print(f"  Note {i+1}: note={note}, velocity={vel}, length={length:.1f}, position={pos:.1f}")
-                    
-                    print("\nFinal array:")
-                    print(midi_notes_array)
-                    
-                    # Process the notes using the record_notes_batch function
-                    record_notes_batch(midi_notes_array)
-                
-                event.handled = True
-                return
-        
-        # Check if we've received all expected notes
-        # if len(midi_notes_array) >= note_count:
-        #     print(f"Received all {note_count} notes")
-        #     receiving_mode = False
-            
-        #     # Print all collected notes
-        #     print(f"Collected {len(midi_notes_array)} notes:")
-        #     for i, (note, vel, length, pos) in enumerate(midi_notes_array):
-        #         print(f"  Note {i+1}: note={note}, velocity={vel}, length={length:.1f}, position={pos:.1f}")
-            
-        #     print("\nFinal array:")
-        #     print(midi_notes_array)
-
-        #     record_notes_batch(midi_notes_array)
-            
-        #     # Process the notes here if needed
-        #     # record_notes_batch(midi_notes_array)
-        
-        # event.handled = True
-        
+    
+    if _receive_value(note):
+        event.handled = True
 
+# MIDI message length by status high nibble (0x8_ to 0xE_ are channel messages)
+STATUS_LEN = bytes((0, 0, 0, 0, 0, 0, 0, 0, 3, 3, 3, 3, 2, 2, 3, 0))
 
-    # elif note == 72:
-    #         collecting_tempo_notes = True
-    #         tempo_note_array = []
-    #         print("Started collecting notes for tempo change")
-    #         event.handled = True
-            
-    #     # End collection and apply tempo change
-    # elif note == 73:
-    #         if collecting_tempo_notes and tempo_note_array:
-    #             bpm = change_tempo_from_notes(tempo_note_array)
-    #             print(f"Tempo changed to {bpm} BPM from collected notes: {tempo_note_array}")
-    #             collecting_tempo_notes = False
-    #             tempo_note_array = []
-    #         else:
-    #             print("No tempo notes collected, tempo unchanged")
-    #         event.handled = True
-            
-    #     # Collect notes for tempo if in collection mode
-    # elif collecting_tempo_notes:
-    #         tempo_note_array.append(note)
-    #         print(f"Added note {note} to tempo collection, current array: {tempo_note_array}")
-    #         event.handled = True
-    
-    # Handle Control Change messages
-    # elif event.status >= midi.MIDI_CONTROLCHANGE and event.status < midi.MIDI_CONTROLCHANGE + 16:
-    #     # CC 100: Select channel to edit
-    #     if event.data1 == 100:
-    #         channel_to_edit = event.data2
-    #         channels.selectOneChannel(channel_to_edit)
-    #         print(f"Selected channel {channel_to_edit} for grid editing")
-    #         event.handled = True
-            
-    #     # CC 110: Select step to edit
-    #     elif event.data1 == 110:
-    #         step_to_edit = event.data2
-    #         print(f"Selected step {step_to_edit} for grid editing")
-    #         event.handled = True
-            
-    #     # CC 111: Toggle step on/off
-    #     elif event.data1 == 111:
-    #         enabled = event.data2 > 0
-    #         channels.setGridBit(channel_to_edit, step_to_edit, enabled)
-    #         print(f"Set grid bit for channel {channel_to_edit}, step {step_to_edit} to {enabled}")
-    #         commit_pattern_changes()  # Force UI update
-    #         event.handled = True
-            
-    #     # CC 112: Set step velocity/level
-    #     elif event.data1 == 112:
-    #         velocity = event.data2
-    #         channels.setStepLevel(channel_to_edit, step_to_edit, velocity)
-    #         print(f"Set step level for channel {channel_to_edit}, step {step_to_edit} to {velocity}")
-    #         commit_pattern_changes()  # Force UI update
-    #         event.handled = True
-        
-    #     # Process other CC messages
-    #     else:
-    #         # Handle other CC messages with your existing code...
-    #         pass
+def feed_bytes(buf):
+    """
+    Run a buffer of raw MIDI bytes through the melody receiver
     
-    # # Handle other MIDI message types if needed
-    # else:
-    #     # Process other MIDI message types
-    #     pass
+    Only Note On messages with a non-zero velocity are passed on, the same
+    as OnMidiMsg does for single events. Running status is supported.
     
-    # Handle Note On messages with your existing code...
-    # [rest of your existing OnMidiMsg function]
-    #record_notes_batch(midi_notes_array)
+    Args:
+        buf (bytes): Raw MIDI byte stream
+    """
+    status = 0
+    count = 0   # Data bytes taken by the current status
+    index = 0   # Data bytes received for the current message
+    data1 = 0
+    
+    # Local names for the globals used on every byte
+    status_len = STATUS_LEN
+    receive = _receive_value
+    for b in buf:
+        if b >= 0xF8:
+            # Real-time bytes may appear anywhere and do not cancel running status
+            continue
+        if b & 0x80:
+            status = b
+            count = status_len[b >> 4] - 1
+            index = 0
+        elif count > 0:
+            if index == 0:
+                data1 = b
+            index += 1
+            if index == count:
+                # Message complete, the next data byte reuses the same status
+                index = 0
+                if status & 0xF0 == 0x90 and b:
+                    receive(data1)
 
-# Make sure your commit_pattern_changes function is defined:
-def commit_pattern_changes(pattern_num=None):
-    """Force FL Studio to update the pattern data visually"""
-    if pattern_num is None:
-        pattern_num = patterns.patternNumber()
-    
-    # Force FL Studio to redraw and commit changes
-    ui.crDisplayRect()
+# Control Change messages edit the channel rack step grid (see grid_trigger.py)
+
+def _cc_select_channel(value):
+    """CC 100: select the channel to edit"""
+    global channel_to_edit
+    channel_to_edit = value
+    channels.selectOneChannel(channel_to_edit)
+    if DEBUG:
+        log(f"Selected channel {channel_to_edit} for grid editing")
+
+def _cc_select_step(value):
+    """CC 110: select the step to edit"""
+    global step_to_edit
+    step_to_edit = value
+    if DEBUG:
+        log(f"Selected step {step_to_edit} for grid editing")
+
+def _cc_set_step(value):
+    """CC 111: turn the selected step on or off"""
+    enabled = value > 0
+    channels.setGridBit(channel_to_edit, step_to_edit, enabled)
+    if DEBUG:
+        log(f"Set grid bit for channel {channel_to_edit}, step {step_to_edit} to {enabled}")
+    commit_pattern_changes()  # Force UI update
+
+def _cc_set_step_level(value):
+    """CC 112: set the selected step's velocity/level"""
+    channels.setStepLevel(channel_to_edit, step_to_edit, value)
+    if DEBUG:
+        log(f"Set step level for channel {channel_to_edit}, step {step_to_edit} to {value}")
+    commit_pattern_changes()  # Force UI update
+
+_CC_DISPATCH = {
+    100: _cc_select_channel,
+    110: _cc_select_step,
+    111: _cc_set_step,
+    112: _cc_set_step_level,
+}
+
+def _handle_control_change(event):
+    """Handle a Control Change message for grid editing"""
+    handler = _CC_DISPATCH.get(event.data1)
+    if handler is not None:
+        handler(event.data2)
+        event.handled = True
+
+def _status_handler(status):
+    """Return the handler for messages with the given status byte"""
+    if midi.MIDI_NOTEON <= status < midi.MIDI_NOTEON + 16:
+        return _handle_note_on
+    if midi.MIDI_CONTROLCHANGE <= status < midi.MIDI_CONTROLCHANGE + 16:
+        return _handle_control_change
+    return _ignore_event
+
+# One handler per status byte, so OnMidiMsg dispatches with a single lookup
+STATUS_KIND = tuple(_status_handler(status) for status in range(256))
+
+def OnMidiMsg(event, timestamp=0, _kind=STATUS_KIND):
+    """Called when a processed MIDI message is received"""
+    _kind[event.status](event)
+
+# SysEx step rows from send_steps in trigger.py: F0, SYSEX_ID, channel, the
+# 16-step mask as 2+7+7 bits, one velocity per step, F7
+SYSEX_ID = 0x7D
+SYSEX_STEPS_LEN = 23
+
+def OnSysEx(event):
+    """Called when a SysEx message is received; sets a whole step row at once"""
+    data = event.sysex
+    if len(data) != SYSEX_STEPS_LEN or data[1] != SYSEX_ID:
+        return
     
-    # Force channel rack to update
-    ui.setFocused(midi.widChannelRack)
+    channel = data[2]
+    mask = (data[3] << 14) | (data[4] << 7) | data[5]
+    set_bit, set_level = channels.setGridBit, channels.setStepLevel
+    for step in range(16):
+        enabled = (mask >> step) & 1
+        set_bit(channel, step, enabled)
+        if enabled:
+            set_level(channel, step, data[6 + step])
+    if DEBUG:
+        log(f"Set step row for channel {channel} to mask {mask:016b}")
+    commit_pattern_changes()  # Force UI update
+    event.handled = True
+
+# UI redraws are coalesced: edits and commands only set bits in
+# pending_refresh, and flush_pattern_changes performs each pending redraw
+# once, at most once per REFRESH_INTERVAL
+REFRESH_INTERVAL = 0.05  # Seconds
+REFRESH_DISPLAY = 1       # ui.crDisplayRect()
+REFRESH_CHANNEL_RACK = 2  # Focus the channel rack
+REFRESH_PLAYLIST = 4      # playlist.refresh()
+REFRESH_PATTERN = REFRESH_DISPLAY | REFRESH_CHANNEL_RACK | REFRESH_PLAYLIST
+pending_refresh = 0
+last_refresh = 0.0
+
+def request_refresh(bits):
+    """
+    Queue UI redraws to run on the next flush
     
-    # Update playlist if needed
-    playlist.refresh()
+    Args:
+        bits (int): REFRESH_* flags to add
+    """
+    global pending_refresh
+    pending_refresh |= bits
+
+def commit_pattern_changes(pattern_num=None):
+    """Mark the pattern as changed so the next flush redraws it"""
+    request_refresh(REFRESH_PATTERN)
+
+def flush_pattern_changes():
+    """Force FL Studio to update the pattern data visually if it changed"""
+    global pending_refresh, last_refresh
+    now = time.monotonic()
+    if not pending_refresh or now - last_refresh < REFRESH_INTERVAL:
+        return
+    bits = pending_refresh
+    pending_refresh = 0
+    last_refresh = now
+    
+    # Redraw first, then focus the channel rack, then update the playlist
+    if bits & REFRESH_DISPLAY:
+        ui.crDisplayRect()
+    if bits & REFRESH_CHANNEL_RACK:
+        ui.setFocused(midi.widChannelRack)
+    if bits & REFRESH_PLAYLIST:
+        playlist.refresh()
+
+def run_queued_commands():
+    """Run every command the terminal thread has queued, until quit"""
+    state = _state
+    while state.running:
+        try:
+            command = _CMD_Q.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            process_command(command)
+        except Exception as e:
+            print(f"Error processing command: {e}")
+
+def OnIdle():
+    """Called periodically by FL Studio while the script is idle"""
+    run_queued_commands()
+    flush_pattern_changes()
+
+# Set when playback stops, so a recording in progress can end early
+_transport_stopped = threading.Event()
+
 def OnTransport(isPlaying):
     """Called when the transport state changes (play/stop)"""
+    # Re-check the live state so a late stop notification from an earlier
+    # recording cannot cut short the one playing now
+    if not isPlaying and not transport.isPlaying():
+        _transport_stopped.set()
     print(f"Transport state changed: {'Playing' if isPlaying else 'Stopped'}")
     return
 
@@ -379,6 +711,28 @@ def OnTempoChange(tempo):
     print(f"Tempo changed to: {tempo} BPM")
     return
 
+# Chord adders unrolled for each chord size, generated on first use
+_CHORD_FNS = {}
+
+def _make_chord_fn(size):
+    """
+    Generate a function that adds a chord of the given size without a loop
+    
+    Args:
+        size (int): Number of notes in the chord
+        
+    Returns:
+        function: add_chord(channel, time_position, length, notes, velocity, pan, addNote)
+    """
+    src = "def add_chord(channel, time_position, length, notes, velocity, pan, addNote):\n"
+    src += "".join(
+        f"    addNote(channel, time_position, length, notes[{i}], velocity, pan)\n"
+        for i in range(size)
+    ) or "    pass\n"
+    namespace = {}
+    exec(src, namespace)
+    return namespace["add_chord"]
+
 def add_chord_to_piano_roll(midi_bytes, time_position=0, length=96):
     """
     Add a chord represented as MIDI bytes to the currently selected piano roll
@@ -399,24 +753,28 @@ def add_chord_to_piano_roll(midi_bytes, time_position=0, length=96):
     # Get the currently selected channel
     channel = channels.selectedChannel()
     
-    print(f"Adding chord to channel {channel} at position {time_position}")
+    if DEBUG:
+        print(f"Adding chord to channel {channel} at position {time_position}")
     
-    # Process each note in the chord
-    for i in range(note_count):
-        if i + 1 < len(midi_bytes):
-            note = midi_bytes[i + 1]
-            velocity = 100  # Default velocity
-            pan = 0  # Center pan
-            
-            # Add the note to the piano roll
-            channels.addNote(channel, time_position, length, note, velocity, pan)
-            print(f"Added note {note} at position {time_position} with length {length}")
+    # Slicing drops any notes missing from a short byte array
+    chord_notes = midi_bytes[1:note_count + 1]
+    velocity = 100  # Default velocity
+    pan = 0  # Center pan
+    
+    # Add each note to the piano roll with the adder for this chord size
+    add_chord = _CHORD_FNS.get(len(chord_notes))
+    if add_chord is None:
+        add_chord = _CHORD_FNS[len(chord_notes)] = _make_chord_fn(len(chord_notes))
+    add_chord(channel, time_position, length, chord_notes, velocity, pan, channels.addNote)
     
     # Force update the UI to show the new notes
     commit_pattern_changes()
-    print(f"Chord with {note_count} notes added to piano roll")
+    print(f"Chord with {len(chord_notes)} notes added to piano roll at position {time_position} with length {length}")
 
 # Terminal interface functions
+# Lines read by the terminal thread, run by OnIdle on FL Studio's own thread
+_CMD_Q = queue.SimpleQueue()
+
 def start_terminal_thread():
     """Start a thread to handle terminal input"""
     global terminal_active
@@ -428,21 +786,154 @@ def start_terminal_thread():
 
 def terminal_loop():
     """Main terminal input loop"""
-    global running, terminal_active
+    global terminal_active
     
     print("\n===== FL STUDIO TERMINAL BEAT BUILDER =====")
     print("Enter commands to build your beat (type 'help' for commands)")
     
-    while running:
+    # This thread only reads input; the blocking input() call releases the
+    # GIL, so MIDI callbacks are not held up while it waits
+    state = _state
+    while state.running:
         try:
             command = input("\nFLBEAT> ")
-            command_history.append(command)
-            process_command(command)
-        except Exception as e:
-            print(f"Error processing command: {e}")
+        except EOFError:
+            break
+        command_history.append(command)
+        _CMD_Q.put(command)
+        # quit only runs later from OnIdle, so stop reading here; otherwise
+        # the next line typed would still be queued and run
+        if tokenize(command)[0] == "quit":
+            break
     
     terminal_active = False
 
+class _TransportState:
+    """Transport flags kept in step with our own start/stop/record calls"""
+    playing = False
+    recording = False
+
+def _sync_transport():
+    """Read the real transport state once, when a recording function starts"""
+    _TransportState.playing = transport.isPlaying()
+    _TransportState.recording = transport.isRecording()
+
+def _start_transport():
+    """Start playback and remember that it is playing"""
+    _transport_stopped.clear()
+    transport.start()
+    _TransportState.playing = True
+
+def _stop_transport():
+    """Stop playback if it is playing"""
+    if _TransportState.playing:
+        transport.stop()
+        _TransportState.playing = False
+
+def _set_recording(want):
+    """
+    Switch recording mode on or off, toggling only if it is not already set
+    
+    Args:
+        want (bool): Whether recording mode should be on
+    """
+    if _TransportState.recording != want:
+        transport.record()
+        _TransportState.recording = want
+
+def _ensure_recording_at(position_ticks):
+    """
+    Stop playback, move to a song position and switch recording mode on
+    
+    Args:
+        position_ticks (int): Song position to record from, in ticks
+    """
+    _sync_transport()
+    _stop_transport()
+    transport.setSongPos(position_ticks, 2)  # 2 = SONGLENGTH_ABSTICKS
+    _set_recording(True)
+
+# How long before each event the scheduler stops waiting on the transport
+# stop event and switches to sleep_until
+WAKE_EARLY_NS = 2_000_000
+
+class MidiScheduler(threading.Thread):
+    """Sends timed note events to a channel from a dedicated thread"""
+    
+    def __init__(self, channel, events):
+        """
+        Args:
+            channel (int): Channel the notes are played on
+            events: List of (offset_ns, note, velocity) tuples, where offset_ns
+                is measured from when the thread starts and velocity 0 is a
+                note-off
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.channel = channel
+        
+        # Order the events by deadline now, before any timing starts, and
+        # keep them as parallel packed arrays rather than a list of tuples
+        events = sorted(events)
+        self.offsets = array.array('q', [event[0] for event in events])
+        self.notes = array.array('B', [event[1] for event in events])
+        self.velocities = array.array('B', [event[2] for event in events])
+    
+    def run(self):
+        # Ask for real-time priority where the platform allows it
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        except (AttributeError, OSError):
+            pass
+        
+        note_on = channels.midiNoteOn
+        channel = self.channel
+        stopped = _transport_stopped
+        start_ns = time.monotonic_ns()
+        try:
+            for offset_ns, note, velocity in zip(self.offsets, self.notes, self.velocities):
+                # Wait on the stop event for all but the last few milliseconds,
+                # so stopping playback ends the recording straight away, then
+                # finish with the precise sleep
+                deadline_ns = start_ns + offset_ns
+                coarse_ns = deadline_ns - WAKE_EARLY_NS - time.monotonic_ns()
+                if coarse_ns > 0 and stopped.wait(coarse_ns / 1e9):
+                    break
+                sleep_until(deadline_ns)
+                note_on(channel, note, velocity)
+            
+            # Playback was stopped; release every note that may still be held
+            if stopped.is_set():
+                for note in set(self.notes):
+                    note_on(channel, note, 0)
+        finally:
+            # Each recording runs on a new thread, so free its timer here
+            close_timer()
+
+def _play_notes_timed(channel, notes, velocities, duration_sec):
+    """
+    Start playback and hold a set of notes together for a fixed time
+    
+    Args:
+        channel (int): Channel the notes are played on
+        notes: MIDI note numbers to play
+        velocities: Velocity for each note
+        duration_sec (float): How long to hold the notes, in seconds
+    """
+    duration_ns = int(duration_sec * 1e9)
+    events = [(0, note, velocity) for note, velocity in zip(notes, velocities)]
+    events += [(duration_ns, note, 0) for note in notes]
+    scheduler = MidiScheduler(channel, events)
+    
+    # Start playback to begin recording, then let the scheduler send the notes
+    _start_transport()
+    scheduler.start()
+    scheduler.join()
+
+# Notes and velocities of the chord played by record_c_major_chord_in_tempo
+_C_MAJOR = (60, 64, 67)  # C4, E4, G4
+_C_MAJOR_VELOCITIES = (100,) * len(_C_MAJOR)
+
 def record_c_major_chord_in_tempo(length_beats=4.0, position_beats=0.0):
     """
     Records a C major chord to the piano roll synced with project tempo
@@ -451,64 +942,29 @@ def record_c_major_chord_in_tempo(length_beats=4.0, position_beats=0.0):
         length_beats (float): Length of chord in beats (1.0 = quarter note)
         position_beats (float): Position to place chord in beats from start
     """
-    # Make sure we're in recording mode and transport is stopped first
-    if transport.isPlaying():
-        transport.stop()
-    
-    if not transport.isRecording():
-        transport.record()
+    # Stop playback, move to the chord and switch recording on
+    _ensure_recording_at(int(position_beats * _ppq()))
     
     # Get the current channel
     channel = channels.selectedChannel()
     
-    # Get the project's PPQ (pulses per quarter note)
-    ppq = general.getRecPPQ()
-    transport.setSongPos(0, 2)
-    
-    # Calculate ticks based on beats
-    length_ticks = int(length_beats * ppq)
-    position_ticks = int(position_beats * ppq)
-    
-    # Set playback position if needed
-    if position_beats > 0:
-        transport.setSongPos(position_ticks, 2)  # 2 = SONGLENGTH_ABSTICKS
-    
-    print(f"Recording C major chord to channel {channel}, length: {length_beats} beats")
-    
-    # Start playback - this begins recording
-    transport.start()
+    # Get the current tempo (BPM) once to know how long the chord lasts
+    tempo = mixer.getCurrentTempo()/1000 if _HAVE_MIXER else 120
     
-    # Play the chord notes
-    channels.midiNoteOn(channel, 60, 100)  # C
-    channels.midiNoteOn(channel, 64, 100)  # E
-    channels.midiNoteOn(channel, 67, 100)  # G
-    
-    # We can't use time.sleep() for tempo synchronization
-    # Instead, we'll monitor the song position until we reach the end point
-    start_pos = transport.getSongPos(2)  # Get current position in ticks
-    end_pos = start_pos + length_ticks
-    
-    # Wait until we reach the end position
-    while transport.getSongPos(2) < end_pos and transport.isPlaying():
-        # Small delay to avoid busy-waiting
-        time.sleep(0.01)
-    
-    # Send note-off events
-    channels.midiNoteOn(channel, 60, 0)  # C off
-    channels.midiNoteOn(channel, 64, 0)  # E off
-    channels.midiNoteOn(channel, 67, 0)  # G off
+    # Play C, E and G for the length of the chord
+    _play_notes_timed(channel, _C_MAJOR, _C_MAJOR_VELOCITIES, length_beats * 60.0 / tempo)
     
     # Stop playback and recording
-    transport.stop()
+    _stop_transport()
     transport.setSongPos(0, 2)
     
     # Exit recording mode
-    if transport.isRecording():
-        transport.record()
+    _set_recording(False)
     
-    print(f"C major chord recorded to piano roll, length: {length_beats} beats")
+    # Report once the chord is down so printing cannot delay the notes
+    print(f"C major chord recorded to channel {channel}, length: {length_beats} beats")
 
-def record_note(note=60, velocity=100, length_beats=1.0, position_beats=0.0, quantize=True):
+def record_note(note=60, velocity=100, length_beats=1.0, position_beats=0.0, quantize=False):
     """
     Records a single note to the piano roll synced with project tempo
     
@@ -517,82 +973,131 @@ def record_note(note=60, velocity=100, length_beats=1.0, position_beats=0.0, qua
         velocity (int): Note velocity (0-127)
         length_beats (float): Length of note in beats (1.0 = quarter note)
         position_beats (float): Position to place note in beats from start
-        quantize (bool): Whether to quantize the recording afterward
+        quantize (bool): Whether to quantize the recording afterward. The
+            note is already snapped to the grid, so this is rarely needed
     """
-    # Make sure transport is stopped first
-    if transport.isPlaying():
-        transport.stop()
+    # Snap to the grid so the note lands on it without quantizing
+    position_beats = _snap(position_beats)
+    length_beats = max(_snap(length_beats), SNAP_GRID)
     
     # Get the current channel
     channel = channels.selectedChannel()
     
-    # Get the project's PPQ (pulses per quarter note)
-    ppq = general.getRecPPQ()
-    
-    # Calculate ticks based on beats
-    length_ticks = int(length_beats * ppq)
-    position_ticks = int(position_beats * ppq)
-    
-    # Set playback position
-    transport.setSongPos(position_ticks, 2)  # 2 = SONGLENGTH_ABSTICKS
-    
-    # Toggle recording mode if needed
-    if not transport.isRecording():
-        transport.record()
+    # Stop playback, move to the note and switch recording on; the note's
+    # length is timed by the scheduler in nanoseconds, so only its start
+    # needs converting to ticks
+    _ensure_recording_at(int(position_beats * _ppq()))
     
-    print(f"Recording note {note} to channel {channel}")
-    print(f"Position: {position_beats} beats, Length: {length_beats} beats")
+    # Messages are written out in one go once recording is finished
+    messages = [f"Recording note {note} to channel {channel}",
+                f"Position: {position_beats} beats, Length: {length_beats} beats"]
     
-    # Calculate the exact tick positions where we need to place note and note-off
-    start_tick = position_ticks
-    end_tick = start_tick + length_ticks
-    
-    # Start playback to begin recording
-    transport.start()
-    
-    # Record the note at the exact start position
-    channels.midiNoteOn(channel, note, velocity)
-    
-    # Get the current tempo (BPM)
-    tempo = 120  # Default fallback
-    
-    # Try to get actual tempo from the project
-    try:
-        import mixer
-        tempo = mixer.getCurrentTempo()
-        tempo = tempo/1000
-        print(f"Using project tempo: {tempo} BPM")
-    except (ImportError, AttributeError):
-        print("Using default tempo: 120 BPM")
+    # Get the current tempo (BPM), falling back to 120 without the mixer module
+    if _HAVE_MIXER:
+        tempo = mixer.getCurrentTempo()/1000
+        messages.append(f"Using project tempo: {tempo} BPM")
+    else:
+        tempo = 120
+        messages.append("Using default tempo: 120 BPM")
     
-    # Calculate the time to wait in seconds
+    # Calculate the time to hold the note in seconds
     seconds_to_wait = (length_beats * 60) / tempo
     
-    print(f"Waiting for {seconds_to_wait:.2f} seconds...")
+    messages.append(f"Held note for {seconds_to_wait:.2f} seconds")
     
-    # Wait the calculated time
-    time.sleep(seconds_to_wait)
-    
-    # Send note-off event
-    channels.midiNoteOn(channel, note, 0)
+    # Note-on as playback starts and note-off once the length has passed
+    _play_notes_timed(channel, (note,), (velocity,), seconds_to_wait)
     
     # Stop playback
-    transport.stop()
+    _stop_transport()
     
-    # Exit recording mode if it was active
-    if transport.isRecording():
-        transport.record()
+    # Exit recording mode
+    _set_recording(False)
     
     # Quantize if requested
     if quantize:
         channels.quickQuantize(channel)
-        print("Recording quantized")
+        messages.append("Recording quantized")
     
-    print(f"Note {note} recorded to piano roll")
+    messages.append(f"Note {note} recorded to piano roll")
+    sys.stdout.write("\n".join(messages) + "\n")
     
     # Return to beginning
     transport.setSongPos(0, 2)
 
+# Common hi-hat MIDI notes:
+# 42 = Closed hi-hat
+# 44 = Pedal hi-hat
+# 46 = Open hi-hat
+
+# Define the pattern as a tuple of notes
+# Each tuple contains (note, velocity, length_beats, position_beats)
+_HIHAT_PATTERN = (
+    # BAR 1 - Basic pattern
+    (42, 90, 0.1, 0.0),     # Closed hat on beat 1
+    (42, 65, 0.1, 0.5),     # Closed hat on off-beat
+    (42, 90, 0.1, 1.0),     # Closed hat on beat 2
+    (42, 65, 0.1, 1.5),     # Closed hat on off-beat
+    (42, 90, 0.1, 2.0),     # Closed hat on beat 3
+    (42, 65, 0.1, 2.5),     # Closed hat on off-beat
+    (42, 90, 0.1, 3.0),     # Closed hat on beat 4
+    (42, 65, 0.1, 3.5),     # Closed hat on off-beat
+    
+    # BAR 2 - Adding 16th notes
+    (42, 90, 0.1, 4.0),     # Closed hat on beat 1
+    (42, 60, 0.1, 4.25),    # Closed hat on 16th
+    (42, 70, 0.1, 4.5),     # Closed hat on off-beat
+    (42, 60, 0.1, 4.75),    # Closed hat on 16th
+    (42, 90, 0.1, 5.0),     # Closed hat on beat 2
+    (42, 60, 0.1, 5.25),    # Closed hat on 16th
+    (42, 70, 0.1, 5.5),     # Closed hat on off-beat
+    (42, 60, 0.1, 5.75),    # Closed hat on 16th
+    (42, 90, 0.1, 6.0),     # Closed hat on beat 3
+    (42, 60, 0.1, 6.25),    # Closed hat on 16th
+    (42, 70, 0.1, 6.5),     # Closed hat on off-beat
+    (42, 60, 0.1, 6.75),    # Closed hat on 16th
+    (42, 90, 0.1, 7.0),     # Closed hat on beat 4
+    (46, 80, 0.2, 7.5),     # Open hat on off-beat
+    
+    # BAR 3 - Mixing closed and open hats
+    (42, 100, 0.1, 8.0),    # Closed hat on beat 1
+    (42, 70, 0.1, 8.5),     # Closed hat on off-beat
+    (46, 85, 0.2, 9.0),     # Open hat on beat 2
+    (42, 70, 0.1, 9.5),     # Closed hat on off-beat
+    (42, 95, 0.1, 10.0),    # Closed hat on beat 3
+    (42, 70, 0.1, 10.5),    # Closed hat on off-beat
+    (46, 85, 0.2, 11.0),    # Open hat on beat 4
+    
+    # Triplet fill at the end of bar 3
+    (42, 80, 0.08, 11.33),  # Closed hat - triplet 1
+    (42, 85, 0.08, 11.66),  # Closed hat - triplet 2
+    (42, 90, 0.08, 11.99),  # Closed hat - triplet 3
+    
+    # BAR 4 - Complex pattern with pedal hats
+    (42, 100, 0.1, 12.0),   # Closed hat on beat 1
+    (44, 75, 0.1, 12.25),   # Pedal hat on 16th
+    (42, 80, 0.1, 12.5),    # Closed hat on off-beat
+    (44, 70, 0.1, 12.75),   # Pedal hat on 16th
+    (42, 90, 0.1, 13.0),    # Closed hat on beat 2
+    (46, 85, 0.3, 13.5),    # Open hat on off-beat
+    
+    # Beat 3-4: Building intensity
+    (42, 95, 0.1, 14.0),    # Closed hat on beat 3
+    (42, 75, 0.1, 14.25),   # Closed hat on 16th
+    (42, 85, 0.1, 14.5),    # Closed hat on off-beat
+    (42, 80, 0.1, 14.75),   # Closed hat on 16th
+    
+    # Final fill
+    (42, 85, 0.05, 15.0),   # Closed hat - 32nd note 1
+    (42, 90, 0.05, 15.125), # Closed hat - 32nd note 2
+    (42, 95, 0.05, 15.25),  # Closed hat - 32nd note 3
+    (42, 100, 0.05, 15.375),# Closed hat - 32nd note 4
+    (42, 105, 0.05, 15.5),  # Closed hat - 32nd note 5
+    (42, 110, 0.05, 15.625),# Closed hat - 32nd note 6
+    (42, 115, 0.05, 15.75), # Closed hat - 32nd note 7
+    (46, 120, 0.25, 15.875),# Open hat - final accent
+)
+
 def rec_hihat_pattern():
     """
     Records a predefined hi-hat pattern to the piano roll using record_notes_batch
@@ -600,98 +1105,37 @@ def rec_hihat_pattern():
     This creates a 4-bar hi-hat pattern with variations in velocity, rhythm, and types of hats
     """
     # Stop playback and rewind to beginning first
-    if transport.isPlaying():
-        transport.stop()
+    _sync_transport()
+    _stop_transport()
     
     transport.setSongPos(0, 2)  # Go to the beginning
     
     print("Recording hi-hat pattern...")
     
-    # Common hi-hat MIDI notes:
-    # 42 = Closed hi-hat
-    # 44 = Pedal hi-hat
-    # 46 = Open hi-hat
-    
-    # Define the pattern as a list of notes
-    # Each tuple contains (note, velocity, length_beats, position_beats)
-    hihat_pattern = [
-        # BAR 1 - Basic pattern
-        (42, 90, 0.1, 0.0),     # Closed hat on beat 1
-        (42, 65, 0.1, 0.5),     # Closed hat on off-beat
-        (42, 90, 0.1, 1.0),     # Closed hat on beat 2
-        (42, 65, 0.1, 1.5),     # Closed hat on off-beat
-        (42, 90, 0.1, 2.0),     # Closed hat on beat 3
-        (42, 65, 0.1, 2.5),     # Closed hat on off-beat
-        (42, 90, 0.1, 3.0),     # Closed hat on beat 4
-        (42, 65, 0.1, 3.5),     # Closed hat on off-beat
-        
-        # BAR 2 - Adding 16th notes
-        (42, 90, 0.1, 4.0),     # Closed hat on beat 1
-        (42, 60, 0.1, 4.25),    # Closed hat on 16th
-        (42, 70, 0.1, 4.5),     # Closed hat on off-beat
-        (42, 60, 0.1, 4.75),    # Closed hat on 16th
-        (42, 90, 0.1, 5.0),     # Closed hat on beat 2
-        (42, 60, 0.1, 5.25),    # Closed hat on 16th
-        (42, 70, 0.1, 5.5),     # Closed hat on off-beat
-        (42, 60, 0.1, 5.75),    # Closed hat on 16th
-        (42, 90, 0.1, 6.0),     # Closed hat on beat 3
-        (42, 60, 0.1, 6.25),    # Closed hat on 16th
-        (42, 70, 0.1, 6.5),     # Closed hat on off-beat
-        (42, 60, 0.1, 6.75),    # Closed hat on 16th
-        (42, 90, 0.1, 7.0),     # Closed hat on beat 4
-        (46, 80, 0.2, 7.5),     # Open hat on off-beat
-        
-        # BAR 3 - Mixing closed and open hats
-        (42, 100, 0.1, 8.0),    # Closed hat on beat 1
-        (42, 70, 0.1, 8.5),     # Closed hat on off-beat
-        (46, 85, 0.2, 9.0),     # Open hat on beat 2
-        (42, 70, 0.1, 9.5),     # Closed hat on off-beat
-        (42, 95, 0.1, 10.0),    # Closed hat on beat 3
-        (42, 70, 0.1, 10.5),    # Closed hat on off-beat
-        (46, 85, 0.2, 11.0),    # Open hat on beat 4
-        
-        # Triplet fill at the end of bar 3
-        (42, 80, 0.08, 11.33),  # Closed hat - triplet 1
-        (42, 85, 0.08, 11.66),  # Closed hat - triplet 2
-        (42, 90, 0.08, 11.99),  # Closed hat - triplet 3
-        
-        # BAR 4 - Complex pattern with pedal hats
-        (42, 100, 0.1, 12.0),   # Closed hat on beat 1
-        (44, 75, 0.1, 12.25),   # Pedal hat on 16th
-        (42, 80, 0.1, 12.5),    # Closed hat on off-beat
-        (44, 70, 0.1, 12.75),   # Pedal hat on 16th
-        (42, 90, 0.1, 13.0),    # Closed hat on beat 2
-        (46, 85, 0.3, 13.5),    # Open hat on off-beat
-        
-        # Beat 3-4: Building intensity
-        (42, 95, 0.1, 14.0),    # Closed hat on beat 3
-        (42, 75, 0.1, 14.25),   # Closed hat on 16th
-        (42, 85, 0.1, 14.5),    # Closed hat on off-beat
-        (42, 80, 0.1, 14.75),   # Closed hat on 16th
-        
-        # Final fill
-        (42, 85, 0.05, 15.0),   # Closed hat - 32nd note 1
-        (42, 90, 0.05, 15.125), # Closed hat - 32nd note 2
-        (42, 95, 0.05, 15.25),  # Closed hat - 32nd note 3
-        (42, 100, 0.05, 15.375),# Closed hat - 32nd note 4
-        (42, 105, 0.05, 15.5),  # Closed hat - 32nd note 5
-        (42, 110, 0.05, 15.625),# Closed hat - 32nd note 6
-        (42, 115, 0.05, 15.75), # Closed hat - 32nd note 7
-        (46, 120, 0.25, 15.875),# Open hat - final accent
-    ]
-    
     # Record the hi-hat pattern using the batch recording function
-    record_notes_batch(hihat_pattern)
+    record_notes_batch(_HIHAT_PATTERN)
     
     print("Hi-hat pattern recording complete!")
     
-    # Quantize the hi-hat pattern
-    channel = channels.selectedChannel()
-    channels.quickQuantize(channel)
-    
     # Return to beginning
     transport.setSongPos(0, 2)
 
+_POSITION_KEY = operator.itemgetter(3)
+
+# Grid in beats that recorded notes are snapped to; 1/48 beat holds both
+# 32nd notes and triplets
+SNAP_GRID = 1 / 48
+
+def _snap(beats, grid=SNAP_GRID):
+    """
+    Round a position or length in beats to the nearest grid line
+    
+    Args:
+        beats (float): Value to snap
+        grid (float): Grid spacing in beats
+    """
+    return round(beats / grid) * grid
+
 def record_notes_batch(notes_array):
     """
     Records a batch of notes to FL Studio, handling simultaneous notes properly
@@ -699,93 +1143,175 @@ def record_notes_batch(notes_array):
     Args:
         notes_array: List of tuples, each containing (note, velocity, length_beats, position_beats)
     """
-    # Sort notes by their starting position
-    sorted_notes = sorted(notes_array, key=lambda x: x[3])
-    
-    # Group notes by their starting positions
-    position_groups = {}
-    for note in sorted_notes:
-        position = note[3]  # position_beats is the 4th element (index 3)
-        if position not in position_groups:
-            position_groups[position] = []
-        position_groups[position].append(note)
-    
-    # Process each position group
-    positions = sorted(position_groups.keys())
-    for position in positions:
-        notes_at_position = position_groups[position]
-        
-        # Find the longest note in this group to determine recording length
-        max_length = max(note[2] for note in notes_at_position)
-        
-        # Make sure transport is stopped first
-        if transport.isPlaying():
-            transport.stop()
-        
-        # Get the current channel
-        channel = channels.selectedChannel()
-        
-        # Get the project's PPQ (pulses per quarter note)
-        ppq = general.getRecPPQ()
-        
-        # Calculate ticks based on beats
-        position_ticks = int(position * ppq)
-        
-        # Set playback position
-        transport.setSongPos(position_ticks, 2)  # 2 = SONGLENGTH_ABSTICKS
-        
-        # Toggle recording mode if needed
-        if not transport.isRecording():
-            transport.record()
-        
-        print(f"Recording {len(notes_at_position)} simultaneous notes at position {position}")
-        
-        # Start playback to begin recording
-        transport.start()
-        
-        # Record all notes at this position simultaneously
-        for note, velocity, length, _ in notes_at_position:
-            channels.midiNoteOn(channel, note, velocity)
-        
-        # Get the current tempo
-        try:
-            import mixer
-            tempo = mixer.getCurrentTempo()
-            tempo = tempo/1000
-        except (ImportError, AttributeError):
-            tempo = 120  # Default fallback
-            
-        print(f"Using tempo: {tempo} BPM")
-        
-        # Calculate the time to wait in seconds based on the longest note
-        seconds_to_wait = (max_length * 60) / tempo
-        
-        print(f"Waiting for {seconds_to_wait:.2f} seconds...")
-        
-        # Wait the calculated time
-        time.sleep(seconds_to_wait)
-        
-        # Send note-off events for all notes
-        for note, _, _, _ in notes_at_position:
-            channels.midiNoteOn(channel, note, 0)
-        
-        # Stop playback
-        transport.stop()
-        
-        # Exit recording mode if it was active
-        if transport.isRecording():
-            transport.record()
-        
-        # Small pause between recordings to avoid potential issues
-        time.sleep(0.2)
+    if not notes_array:
+        return
+    
+    # These do not change during a batch, so read them once
+    channel = channels.selectedChannel()
+    ppq = _ppq()
+    tempo = mixer.getCurrentTempo()/1000 if _HAVE_MIXER else 120
+    ns_per_beat = 60.0 / tempo * 1e9
+    
+    # Recording starts at the earliest note (position_beats is index 3)
+    start_position = _snap(min(map(_POSITION_KEY, notes_array)))
+    
+    # Time every note-on and note-off from the start of the pass. Notes are
+    # snapped to the grid here, so they land on it without a quantize pass
+    events = []
+    add_event = events.append
+    for note, velocity, length, position in notes_array:
+        offset = _snap(position) - start_position
+        length = max(_snap(length), SNAP_GRID)
+        add_event((int(offset * ns_per_beat), note, velocity))
+        add_event((int((offset + length) * ns_per_beat), note, 0))
+    scheduler = MidiScheduler(channel, events)
+    
+    # Stop playback, move to the first note and switch recording on
+    _ensure_recording_at(int(start_position * ppq))
+    
+    # Record the whole batch in one continuous pass
+    _start_transport()
+    scheduler.start()
+    scheduler.join()
+    
+    # Stop playback
+    _stop_transport()
+    
+    # Exit recording mode
+    _set_recording(False)
     
-    print("All notes recorded successfully")
+    # Printing is left until recording is over so it cannot delay any notes
+    sys.stdout.write(f"Recorded {len(notes_array)} notes from position {start_position} at {tempo} BPM\n"
+                     "All notes recorded successfully\n")
     
     # Return to beginning
     transport.setSongPos(0, 2)
 
 
 
+# Define the melody as a tuple of notes
+# Each tuple contains (note, velocity, length_beats, position_beats)
+_MELODY = (
+    # BAR 1
+    # Beat 1: C major chord
+    (60, 100, 1.0, 0.0),    # C4 - root note
+    (64, 85, 1.0, 0.0),     # E4 - chord tone
+    (67, 80, 1.0, 0.0),     # G4 - chord tone
+    
+    # Beat 1.5: Melody note
+    (72, 110, 0.5, 0.5),    # C5 - melody
+    
+    # Beat 2: G7 chord
+    (55, 90, 1.0, 1.0),     # G3 - bass note
+    (59, 75, 1.0, 1.0),     # B3 - chord tone
+    (62, 75, 1.0, 1.0),     # D4 - chord tone
+    (65, 75, 1.0, 1.0),     # F4 - chord tone
+    
+    # Beat 2.5-3: Melody phrase
+    (71, 105, 0.25, 1.5),   # B4 - melody
+    (69, 95, 0.25, 1.75),   # A4 - melody
+    (67, 90, 0.5, 2.0),     # G4 - melody
+    
+    # Beat 3: C major chord
+    (48, 95, 1.0, 2.0),     # C3 - bass note
+    (64, 75, 1.0, 2.0),     # E4 - chord tone
+    (67, 75, 1.0, 2.0),     # G4 - chord tone
+    
+    # Beat 4: Melody fill
+    (64, 100, 0.5, 3.0),    # E4 - melody
+    (65, 90, 0.25, 3.5),    # F4 - melody
+    (67, 95, 0.25, 3.75),   # G4 - melody
+    
+    # BAR 2
+    # Beat 1: Am chord
+    (57, 95, 1.0, 4.0),     # A3 - bass note
+    (60, 80, 1.0, 4.0),     # C4 - chord tone
+    (64, 80, 1.0, 4.0),     # E4 - chord tone
+    
+    # Beat 1-2: Melody note
+    (69, 110, 0.75, 4.0),   # A4 - melody
+    (67, 90, 0.25, 4.75),   # G4 - melody
+    
+    # Beat 2: F major chord
+    (53, 90, 1.0, 5.0),     # F3 - bass note
+    (57, 75, 1.0, 5.0),     # A3 - chord tone
+    (60, 75, 1.0, 5.0),     # C4 - chord tone
+    
+    # Beat 2.5-3: Melody
+    (65, 100, 0.5, 5.5),    # F4 - melody
+    (64, 90, 0.5, 6.0),     # E4 - melody
+    
+    # Beat 3: G7 chord
+    (55, 95, 1.0, 6.0),     # G3 - bass note
+    (59, 80, 1.0, 6.0),     # B3 - chord tone
+    (62, 80, 1.0, 6.0),     # D4 - chord tone
+    
+    # Beat 3.5-4: Melody fill
+    (62, 100, 0.25, 6.5),   # D4 - melody
+    (64, 95, 0.25, 6.75),   # E4 - melody
+    (65, 90, 0.25, 7.0),    # F4 - melody
+    (67, 105, 0.75, 7.25),  # G4 - melody
+    
+    # BAR 3
+    # Beat 1: C major chord
+    (48, 100, 1.0, 8.0),    # C3 - bass note
+    (60, 85, 1.0, 8.0),     # C4 - chord tone
+    (64, 85, 1.0, 8.0),     # E4 - chord tone
+    (67, 85, 1.0, 8.0),     # G4 - chord tone
+    
+    # Beat 1-2: Melody
+    (72, 110, 1.0, 8.0),    # C5 - melody
+    
+    # Beat 2: Em chord
+    (52, 90, 1.0, 9.0),     # E3 - bass note
+    (59, 75, 1.0, 9.0),     # B3 - chord tone
+    (64, 75, 1.0, 9.0),     # E4 - chord tone
+    
+    # Beat 2.5-3.5: Melody run
+    (71, 105, 0.25, 9.5),   # B4 - melody
+    (72, 100, 0.25, 9.75),  # C5 - melody
+    (74, 110, 0.5, 10.0),   # D5 - melody
+    (76, 115, 0.5, 10.5),   # E5 - melody
+    
+    # Beat 3: Am chord
+    (57, 95, 1.0, 10.0),    # A3 - bass note
+    (60, 80, 1.0, 10.0),    # C4 - chord tone
+    (64, 80, 1.0, 10.0),    # E4 - chord tone
+    
+    # Beat 4: Descending run
+    (74, 100, 0.25, 11.0),  # D5 - melody
+    (72, 95, 0.25, 11.25),  # C5 - melody
+    (71, 90, 0.25, 11.5),   # B4 - melody
+    (69, 85, 0.25, 11.75),  # A4 - melody
+    
+    # BAR 4
+    # Beat 1: F major chord
+    (53, 95, 1.0, 12.0),    # F3 - bass note
+    (60, 80, 1.0, 12.0),    # C4 - chord tone
+    (65, 80, 1.0, 12.0),    # F4 - chord tone
+    
+    # Beat 1-2: Melody
+    (67, 100, 1.0, 12.0),   # G4 - melody
+    
+    # Beat 2: G7 chord
+    (55, 90, 1.0, 13.0),    # G3 - bass note
+    (59, 75, 1.0, 13.0),    # B3 - chord tone
+    (62, 75, 1.0, 13.0),    # D4 - chord tone
+    
+    # Beat 2-3: Melody
+    (65, 95, 0.5, 13.0),    # F4 - melody
+    (64, 90, 0.5, 13.5),    # E4 - melody
+    
+    # Beat 3-4: Final C major chord
+    (48, 110, 2.0, 14.0),   # C3 - bass note
+    (60, 95, 2.0, 14.0),    # C4 - chord tone
+    (64, 95, 2.0, 14.0),    # E4 - chord tone
+    (67, 95, 2.0, 14.0),    # G4 - chord tone
+    
+    # Final melody note
+    (72, 120, 2.0, 14.0),   # C5 - melody final note
+)
+
 def rec_melody():
     """
     Records a predefined melody to the piano roll by calling record_notes_batch
@@ -793,138 +1319,15 @@ def rec_melody():
     The melody is a robust 4-bar composition with melody notes and chord accompaniment
     """
     # Stop playback and rewind to beginning first
-    if transport.isPlaying():
-        transport.stop()
+    _sync_transport()
+    _stop_transport()
     
     transport.setSongPos(0, 2)  # Go to the beginning
     
     print("Recording melody...")
     
-    # Define the melody as a list of notes
-    # Each tuple contains (note, velocity, length_beats, position_beats)
-    melody = [
-        # BAR 1
-        # Beat 1: C major chord
-        (60, 100, 1.0, 0.0),    # C4 - root note
-        (64, 85, 1.0, 0.0),     # E4 - chord tone
-        (67, 80, 1.0, 0.0),     # G4 - chord tone
-        
-        # Beat 1.5: Melody note
-        (72, 110, 0.5, 0.5),    # C5 - melody
-        
-        # Beat 2: G7 chord
-        (55, 90, 1.0, 1.0),     # G3 - bass note
-        (59, 75, 1.0, 1.0),     # B3 - chord tone
-        (62, 75, 1.0, 1.0),     # D4 - chord tone
-        (65, 75, 1.0, 1.0),     # F4 - chord tone
-        
-        # Beat 2.5-3: Melody phrase
-        (71, 105, 0.25, 1.5),   # B4 - melody
-        (69, 95, 0.25, 1.75),   # A4 - melody
-        (67, 90, 0.5, 2.0),     # G4 - melody
-        
-        # Beat 3: C major chord
-        (48, 95, 1.0, 2.0),     # C3 - bass note
-        (64, 75, 1.0, 2.0),     # E4 - chord tone
-        (67, 75, 1.0, 2.0),     # G4 - chord tone
-        
-        # Beat 4: Melody fill
-        (64, 100, 0.5, 3.0),    # E4 - melody
-        (65, 90, 0.25, 3.5),    # F4 - melody
-        (67, 95, 0.25, 3.75),   # G4 - melody
-        
-        # BAR 2
-        # Beat 1: Am chord
-        (57, 95, 1.0, 4.0),     # A3 - bass note
-        (60, 80, 1.0, 4.0),     # C4 - chord tone
-        (64, 80, 1.0, 4.0),     # E4 - chord tone
-        
-        # Beat 1-2: Melody note
-        (69, 110, 0.75, 4.0),   # A4 - melody
-        (67, 90, 0.25, 4.75),   # G4 - melody
-        
-        # Beat 2: F major chord
-        (53, 90, 1.0, 5.0),     # F3 - bass note
-        (57, 75, 1.0, 5.0),     # A3 - chord tone
-        (60, 75, 1.0, 5.0),     # C4 - chord tone
-        
-        # Beat 2.5-3: Melody
-        (65, 100, 0.5, 5.5),    # F4 - melody
-        (64, 90, 0.5, 6.0),     # E4 - melody
-        
-        # Beat 3: G7 chord
-        (55, 95, 1.0, 6.0),     # G3 - bass note
-        (59, 80, 1.0, 6.0),     # B3 - chord tone
-        (62, 80, 1.0, 6.0),     # D4 - chord tone
-        
-        # Beat 3.5-4: Melody fill
-        (62, 100, 0.25, 6.5),   # D4 - melody
-        (64, 95, 0.25, 6.75),   # E4 - melody
-        (65, 90, 0.25, 7.0),    # F4 - melody
-        (67, 105, 0.75, 7.25),  # G4 - melody
-        
-        # BAR 3
-        # Beat 1: C major chord
-        (48, 100, 1.0, 8.0),    # C3 - bass note
-        (60, 85, 1.0, 8.0),     # C4 - chord tone
-        (64, 85, 1.0, 8.0),     # E4 - chord tone
-        (67, 85, 1.0, 8.0),     # G4 - chord tone
-        
-        # Beat 1-2: Melody
-        (72, 110, 1.0, 8.0),    # C5 - melody
-        
-        # Beat 2: Em chord
-        (52, 90, 1.0, 9.0),     # E3 - bass note
-        (59, 75, 1.0, 9.0),     # B3 - chord tone
-        (64, 75, 1.0, 9.0),     # E4 - chord tone
-        
-        # Beat 2.5-3.5: Melody run
-        (71, 105, 0.25, 9.5),   # B4 - melody
-        (72, 100, 0.25, 9.75),  # C5 - melody
-        (74, 110, 0.5, 10.0),   # D5 - melody
-        (76, 115, 0.5, 10.5),   # E5 - melody
-        
-        # Beat 3: Am chord
-        (57, 95, 1.0, 10.0),    # A3 - bass note
-        (60, 80, 1.0, 10.0),    # C4 - chord tone
-        (64, 80, 1.0, 10.0),    # E4 - chord tone
-        
-        # Beat 4: Descending run
-        (74, 100, 0.25, 11.0),  # D5 - melody
-        (72, 95, 0.25, 11.25),  # C5 - melody
-        (71, 90, 0.25, 11.5),   # B4 - melody
-        (69, 85, 0.25, 11.75),  # A4 - melody
-        
-        # BAR 4
-        # Beat 1: F major chord
-        (53, 95, 1.0, 12.0),    # F3 - bass note
-        (60, 80, 1.0, 12.0),    # C4 - chord tone
-        (65, 80, 1.0, 12.0),    # F4 - chord tone
-        
-        # Beat 1-2: Melody
-        (67, 100, 1.0, 12.0),   # G4 - melody
-        
-        # Beat 2: G7 chord
-        (55, 90, 1.0, 13.0),    # G3 - bass note
-        (59, 75, 1.0, 13.0),    # B3 - chord tone
-        (62, 75, 1.0, 13.0),    # D4 - chord tone
-        
-        # Beat 2-3: Melody
-        (65, 95, 0.5, 13.0),    # F4 - melody
-        (64, 90, 0.5, 13.5),    # E4 - melody
-        
-        # Beat 3-4: Final C major chord
-        (48, 110, 2.0, 14.0),   # C3 - bass note
-        (60, 95, 2.0, 14.0),    # C4 - chord tone
-        (64, 95, 2.0, 14.0),    # E4 - chord tone
-        (67, 95, 2.0, 14.0),    # G4 - chord tone
-        
-        # Final melody note
-        (72, 120, 2.0, 14.0),   # C5 - melody final note
-    ]
-    
     # Record the melody using the batch recording function
-    record_notes_batch(melody)
+    record_notes_batch(_MELODY)
     
     print("Melody recording complete!")
     
@@ -942,10 +1345,7 @@ def change_tempo_from_notes(note_array):
     bpm_value = midi_notes_to_int(note_array)
     
     # Limit to a reasonable BPM range
-    if bpm_value < 20:
-        bpm_value = 20  # Minimum reasonable tempo
-    elif bpm_value > 999:
-        bpm_value = 999  # Maximum reasonable tempo
+    bpm_value = _clamp(bpm_value, 20, 999)
     
     # Change the tempo
     print(f"Changing tempo to {bpm_value} BPM from note array {note_array}")
@@ -953,5 +1353,343 @@ def change_tempo_from_notes(note_array):
     
     return bpm_value
 
+# The help text is written in one call through a bound stdout.write
+_out = sys.stdout.write
+
+# Printed by the help command
+_HELP_TEXT = """
+Commands:
+  help                         Show this list
+  play | stop | record         Control the transport
+  save                         Save the project
+  loop [on|off|toggle]         Set or toggle loop recording (not the
+                               pattern/song mode); no argument toggles
+  bpm <value>                  Set the tempo
+  refresh                      Redraw the channel rack and playlist
+  pattern new                  Jump to the first empty pattern
+  pattern select <n>           Jump to pattern n
+  pattern clone                Clone the current pattern
+  channel select <n>           Select channel n
+  mixer select <n>             Select mixer track n
+  mixer volume [0.0-1.0]       Show or set the selected track's volume
+  note <name> [beats] [vel]    Record a note, e.g. note C#4 0.5 100
+                               (the octave defaults to 4)
+  chord [beats]                Record a C major chord
+  hihat                        Record the hi-hat pattern
+  melody                       Record the melody
+  quit                         Close the terminal
+"""
+
+def show_help(_out=_out, _text=_HELP_TEXT):
+    """Print the commands understood by the terminal"""
+    _out(_text)
+
+# Numeric arguments repeat a lot when commands come from a script or a
+# macro pad, so parsed (and validated) values are memoized by their text
+
+def _unsigned(text):
+    """Return text without a single leading '+' or '-'"""
+    return text[1:] if text[:1] in ('+', '-') else text
+
+def _try_float(text):
+    """Return text as a float, or None if it is not a plain decimal number"""
+    if _unsigned(text).replace('.', '', 1).isdecimal():
+        return float(text)
+    return None
+
+def _try_int(text):
+    """Return text as an int, or None if it is not a plain integer"""
+    if _unsigned(text).isdecimal():
+        return int(text)
+    return None
+
+@functools.lru_cache(maxsize=256)
+def _parse_volume(text):
+    """Parse a mixer volume, or return None if it is not in 0.0-1.0"""
+    volume = _try_float(text)
+    if volume is None or not 0.0 <= volume <= 1.0:
+        return None
+    return volume
+
+@functools.lru_cache(maxsize=256)
+def _parse_bpm(text):
+    """Parse a tempo limited to 20-999 BPM, or return None if not a number"""
+    bpm = _try_float(text)
+    return None if bpm is None else _clamp(bpm, 20, 999)
+
+@functools.lru_cache(maxsize=256)
+def _parse_index(text):
+    """Parse a pattern, channel or mixer track number, or return None"""
+    return _try_int(text)
+
+# Command handlers take the arguments after the command name. FL Studio
+# modules are bound as default arguments so a call skips the global lookup.
+# Status lines go through log(), so a burst of commands never waits on the
+# console; usage errors are printed straight away
+
+def _cmd_help(args):
+    show_help()
+
+def _cmd_play(args, transport=transport):
+    transport.start()
+
+def _cmd_stop(args, transport=transport):
+    transport.stop()
+
+def _cmd_record(args, transport=transport):
+    transport.record()
+
+def _cmd_save(args, transport=transport):
+    transport.globalTransport(midi.FPT_Save, 1)
+    log("Project saved")
+
+# loop argument mapped to the wanted loop recording state; -1 toggles.
+# This is loop recording, not transport.setLoopMode(), which only flips
+# between pattern and song mode and has no on/off state
+_LOOP_MODES = {"on": 1, "off": 0, "toggle": -1}
+
+def _cmd_loop(args, ui=ui, transport=transport):
+    mode = _LOOP_MODES.get(args[0].lower()) if args else -1
+    if mode is None:
+        print("Usage: loop [on|off|toggle]")
+        return
+    if mode != ui.isLoopRecEnabled():
+        transport.globalTransport(midi.FPT_LoopRecord, 1)
+    log(f"Loop recording {'on' if ui.isLoopRecEnabled() else 'off'}")
+
+def _cmd_bpm(args):
+    bpm = _parse_bpm(args[0]) if args else None
+    if bpm is None:
+        print("Usage: bpm <value>")
+        return
+    change_tempo(bpm)
+    log(f"Tempo set to {bpm} BPM")
+
+def _cmd_refresh(args):
+    request_refresh(REFRESH_DISPLAY | REFRESH_PLAYLIST)
+    log("UI refresh queued")
+
+def _pattern_new(args, patterns=patterns):
+    global current_pattern
+    patterns.findFirstNextEmptyPat(midi.FFNEP_FindFirst)
+    current_pattern = patterns.patternNumber()
+    log(f"Created pattern {current_pattern}")
+
+def _pattern_select(args, patterns=patterns):
+    global current_pattern
+    index = _parse_index(args[0]) if args else None
+    if index is None:
+        print("Usage: pattern select <n>")
+        return
+    patterns.jumpToPattern(index)
+    current_pattern = index
+    log(f"Selected pattern {index}")
+
+def _pattern_clone(args, patterns=patterns):
+    patterns.clonePattern(patterns.patternNumber())
+    log("Pattern cloned")
+
+def _channel_select(args, channels=channels):
+    global current_channel
+    index = _parse_index(args[0]) if args else None
+    if index is None:
+        print("Usage: channel select <n>")
+        return
+    channels.selectOneChannel(index)
+    current_channel = index
+    log(f"Selected channel {index}")
+
+# The selected mixer track is cached until it is changed, either by the
+# mixer select command or in FL Studio (see OnRefresh). The last volume read
+# is reused for VOLUME_TTL seconds
+VOLUME_TTL = 0.05  # Seconds
+_cached_track = None
+_cached_volume = None  # (track, volume, time.monotonic())
+
+def _track(mixer=mixer):
+    """Return the selected mixer track, asking FL Studio only when not cached"""
+    global _cached_track
+    if _cached_track is None:
+        _cached_track = mixer.trackNumber()
+    return _cached_track
+
+def _invalidate_mixer_cache(track=True):
+    """Forget the cached volume, and the cached track unless told not to"""
+    global _cached_track, _cached_volume
+    if track:
+        _cached_track = None
+    _cached_volume = None
+
+def _mixer_select(args, mixer=mixer):
+    global _cached_track
+    track = _parse_index(args[0]) if args else None
+    if track is None:
+        print("Usage: mixer select <n>")
+        return
+    mixer.setTrackNumber(track)
+    _cached_track = track
+    log(f"Selected mixer track {track}")
+
+def _mixer_volume(args, mixer=mixer):
+    global _cached_volume
+    track = _track()
+    now = time.monotonic()
+    if not args:
+        cached = _cached_volume
+        if cached is not None and cached[0] == track and now - cached[2] < VOLUME_TTL:
+            volume = cached[1]
+        else:
+            volume = mixer.getTrackVolume(track)
+            _cached_volume = (track, volume, now)
+        log(f"Mixer track {track} volume: {volume}")
+        return
+    volume = _parse_volume(args[0])
+    if volume is None:
+        print("Invalid volume value (0.0 to 1.0)")
+        return
+    mixer.setTrackVolume(track, volume)
+    _cached_volume = (track, volume, now)
+    log(f"Set mixer track {track} volume to {volume}")
+
+# Two-word commands, keyed on (command, subcommand). Mixer subcommands are
+# only registered when the mixer module is available
+_SUBCOMMANDS = {
+    ("pattern", "new"): _pattern_new,
+    ("pattern", "select"): _pattern_select,
+    ("pattern", "clone"): _pattern_clone,
+    ("channel", "select"): _channel_select,
+}
+if _HAVE_MIXER:
+    _SUBCOMMANDS[("mixer", "select")] = _mixer_select
+    _SUBCOMMANDS[("mixer", "volume")] = _mixer_volume
+
+def _print_usage(name):
+    """Print the subcommands of a two-word command"""
+    subs = "|".join(sub for cmd, sub in _SUBCOMMANDS if cmd == name)
+    print(f"Usage: {name} [{subs}] ...")
+
+# These only run when no known subcommand followed the command name
+
+def _cmd_pattern(args):
+    _print_usage("pattern")
+
+def _cmd_channel(args):
+    _print_usage("channel")
+
+def _cmd_mixer(args):
+    if not _HAVE_MIXER:
+        print("Mixer commands need the mixer module")
+        return
+    _print_usage("mixer")
+
+# Notes from consecutive note commands are collected here and recorded
+# together in one pass by the record worker
+_pending_notes = []
+_pending_lock = threading.Lock()
+
+def _record_pending_notes():
+    """Record every note queued by the note command as one batch"""
+    with _pending_lock:
+        notes = _pending_notes[:]
+        del _pending_notes[:]
+    record_notes_batch(notes)
+
+def _cmd_note(args):
+    if not args or args[0].upper() not in NOTE_TABLE:
+        print("Usage: note <name> [beats] [velocity], e.g. note C#4 0.5 100")
+        return
+    note = NOTE_TABLE[args[0].upper()]
+    length = _try_float(args[1]) if len(args) > 1 else 1.0
+    velocity = _try_int(args[2]) if len(args) > 2 else 100
+    if length is None or velocity is None:
+        print("Note length and velocity must be numbers")
+        return
+    velocity = _clamp(velocity, 0, 127)
+    
+    # Only the first note of a run queues a job; later ones join its batch
+    with _pending_lock:
+        _pending_notes.append((note, velocity, length, 0.0))
+        first = len(_pending_notes) == 1
+    if first:
+        run_in_background(_record_pending_notes)
+
+def _cmd_chord(args):
+    length = _try_float(args[0]) if args else 4.0
+    if length is None:
+        print("Usage: chord [beats]")
+        return
+    run_in_background(record_c_major_chord_in_tempo, length)
+
+def _cmd_hihat(args):
+    run_in_background(rec_hihat_pattern)
+
+def _cmd_melody(args):
+    run_in_background(rec_melody)
+
+def _cmd_quit(args):
+    _state.running = False
+    log("Terminal closed")
+
+# Terminal command names mapped to their handlers
+_COMMANDS = {
+    "help": _cmd_help,
+    "play": _cmd_play,
+    "stop": _cmd_stop,
+    "record": _cmd_record,
+    "save": _cmd_save,
+    "loop": _cmd_loop,
+    "bpm": _cmd_bpm,
+    "refresh": _cmd_refresh,
+    "pattern": _cmd_pattern,
+    "channel": _cmd_channel,
+    "mixer": _cmd_mixer,
+    "note": _cmd_note,
+    "chord": _cmd_chord,
+    "hihat": _cmd_hihat,
+    "melody": _cmd_melody,
+    "quit": _cmd_quit,
+}
+
+def tokenize(line):
+    """
+    Split a command line into its lower-cased command name and arguments
+    
+    Args:
+        line (str): Line typed into the terminal
+    
+    Returns:
+        tuple: (command, args), or ("", ()) for a blank line
+    """
+    # Split off the command name only; the rest is split once, if present
+    parts = line.split(None, 1)
+    if not parts:
+        return "", ()
+    if len(parts) == 1:
+        return parts[0].lower(), ()
+    return parts[0].lower(), tuple(parts[1].split())
+
+def process_command(command):
+    """
+    Run one line typed into the terminal
+    
+    Args:
+        command (str): Command name followed by its arguments
+    """
+    cmd, args = tokenize(command)
+    if not cmd:
+        return
+    
+    if args:
+        handler = _SUBCOMMANDS.get((cmd, args[0].lower()))
+        if handler is not None:
+            handler(args[1:])
+            return
+    
+    handler = _COMMANDS.get(cmd)
+    if handler is None:
+        print(f"Unknown command: {cmd} (type 'help' for commands)")
+        return
+    handler(args)
+
 # Start the terminal interface when loaded in FL Studio
 # No need to call this explicitly as OnInit will be called by FL Studio
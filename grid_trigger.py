@@ -1,6 +1,7 @@
 import mido
 from mido import Message
 import time
+import functools
 
 # Open the output port to communicate with FL Studio
 # Replace with your port name - you may need to check available ports
@@ -44,15 +45,25 @@ CLAP = 39      # D#1
 CLOSED_HAT = 42  # F#1
 OPEN_HAT = 46  # A#1
 
+# Shared message instances, built once per distinct value set. Messages are
+# never modified after sending, so the same object can be reused every time
+@functools.lru_cache(maxsize=4096)
+def _msg(kind, note, velocity):
+    """Return the note message for (kind, note, velocity)"""
+    return Message(kind, note=note, velocity=velocity)
+
+@functools.lru_cache(maxsize=4096)
+def _cc(channel, control, value):
+    """Return the control change message for (channel, control, value)"""
+    return Message('control_change', channel=channel, control=control, value=value)
+
 # Send a MIDI note message
 def send_midi_note(note, velocity=100, duration=0.1):
     """Send a MIDI note on/off message with specified duration"""
-    note_on = Message('note_on', note=note, velocity=velocity)
-    output_port.send(note_on)
+    output_port.send(_msg('note_on', note, velocity))
     print(f"Sent MIDI note {note} (on), velocity {velocity}")
     time.sleep(duration)
-    note_off = Message('note_off', note=note, velocity=0)
-    output_port.send(note_off)
+    output_port.send(_msg('note_off', note, 0))
     print(f"Sent MIDI note {note} (off)")
     time.sleep(0.1)  # Small pause between messages
 
@@ -62,8 +73,7 @@ def send_midi_cc(control, value, channel=0):
     if value > 127:
         print(f"Warning: Value {value} exceeds MIDI range (0-127)")
         value = 127
-    cc = Message('control_change', channel=channel, control=control, value=value)
-    output_port.send(cc)
+    output_port.send(_cc(channel, control, value))
     print(f"Sent CC: control={control}, value={value}")
     time.sleep(0.1)  # Small pause between messages
 
@@ -121,45 +131,112 @@ def create_channel(name):
     send_midi_note(NOTE_NAME_CHANNEL)
     time.sleep(0.2)
     
-    for char in name:
-        send_midi_cc(2, ord(char))
-        time.sleep(0.05)
-    
-    send_midi_cc(2, 0)  # Terminator
+    # One CC per character and a 0 terminator, sent as a single burst with
+    # no pause between characters. ASCII bytes already fit in a CC value;
+    # anything else is sent as '?'
+    send_batch([_cc(0, 2, b) for b in name.encode('ascii', 'replace')] + [_cc(0, 2, 0)])
     time.sleep(0.5)
     print(f"Channel '{name}' created successfully")
 
-# Set a specific step in the step sequencer grid
-def set_step(channel, step, enabled=True, velocity=100):
+# Build the CC messages for one step in the step sequencer grid
+def step_messages(channel, step, enabled=True, velocity=100):
     """
-    Set a step in the FL Studio step sequencer grid. 
-    Basically a midi note. 
-    (The visual element of the Midi Note in the channel rack). 
+    Build the CC messages that set a step in the FL Studio step sequencer grid
     
     Args:
         channel: Channel index (0-based)
         step: Step index (0-15)
         enabled: Whether the step is active
         velocity: Velocity/level for the step (0-127)
+        
+    Returns:
+        list: The messages to send, in order
+    """
+    messages = [
+        _cc(0, CC_SELECT_CHANNEL, channel),
+        _cc(0, CC_SELECT_STEP, step),
+        _cc(0, CC_TOGGLE_STEP, 1 if enabled else 0),
+    ]
+    # Set the velocity/level if the step is enabled
+    if enabled:
+        messages.append(_cc(0, CC_STEP_VELOCITY, velocity))
+    return messages
+
+# Send a batch of MIDI messages back to back
+def send_batch(messages):
     """
-    print(f"Setting channel {channel}, step {step}, enabled={enabled}, velocity={velocity}")
+    Send a list of MIDI messages without pausing between them
     
-    # Select the channel
-    send_midi_cc(CC_SELECT_CHANNEL, channel)
-    time.sleep(0.1)
+    FL Studio handles the CCs as they arrive and in order, so the messages
+    only need to reach the port, not be spaced out.
     
-    # Select the step
-    send_midi_cc(CC_SELECT_STEP, step)
-    time.sleep(0.1)
+    Args:
+        messages: The messages to send
+    """
+    send = output_port.send
+    for message in messages:
+        send(message)
+    print(f"Sent {len(messages)} messages")
+
+# Step grids for the preset beats, as (name, channel, ((step, velocity), ...))
+BASIC_BEAT_STEPS = (
+    ("kick", 0, ((0, 100), (4, 100), (8, 100), (12, 100))),  # Every quarter note
+    ("clap", 1, ((4, 90), (12, 90))),  # Beats 2 and 4
+    # Eighth notes, accented on the beat
+    ("hi-hat", 2, tuple((step, 90 if step % 4 == 0 else 70) for step in range(0, 16, 2))),
+    ("snare", 3, ((4, 95), (12, 95))),  # Beats 2 and 4
+)
+
+TRAP_BEAT_STEPS = (
+    ("808 kick", 0, ((0, 100), (6, 80), (8, 100), (14, 90))),  # Trap style with ghost notes
+    ("clap", 1, ((4, 95), (12, 95))),  # Beats 2 and 4
+    # 16th notes with velocity variations
+    ("hi-hat", 2, tuple(enumerate((90, 60, 75, 60) * 4))),
+    ("open hi-hat", 3, ((2, 85), (10, 85))),  # Accents
+    ("808 bass", 4, ((0, 100), (8, 95))),
+)
+
+HOUSE_BEAT_STEPS = (
+    ("kick", 0, ((0, 100), (4, 100), (8, 100), (12, 100))),  # Four-on-the-floor
+    ("clap", 1, ((4, 90), (12, 90))),  # Beats 2 and 4
+    ("closed hi-hat", 2, ((2, 85), (6, 85), (10, 85), (14, 85))),  # Offbeats
+    ("open hi-hat", 3, ((7, 85),)),  # Single open hat accent
+    ("bass", 4, ((0, 100), (4, 90), (8, 100), (12, 90))),
+)
+
+def grid_messages(patterns):
+    """
+    Build the CC messages for a whole step grid
     
-    # Enable/disable the step
-    send_midi_cc(CC_TOGGLE_STEP, 1 if enabled else 0)
-    time.sleep(0.1)
+    Args:
+        patterns: Sequence of (name, channel, ((step, velocity), ...)) entries
+        
+    Returns:
+        tuple: (pattern names, every step's messages in order)
+    """
+    messages = []
+    build = step_messages
+    for name, channel, steps in patterns:
+        for step, velocity in steps:
+            messages += build(channel, step, True, velocity)
+    return tuple(name for name, channel, steps in patterns), tuple(messages)
+
+def send_grid(grid):
+    """
+    Send a prebuilt step grid in one batch
     
-    # Set the velocity/level if the step is enabled
-    if enabled:
-        send_midi_cc(CC_STEP_VELOCITY, velocity)
-        time.sleep(0.1)
+    Args:
+        grid: (names, messages) pair built by grid_messages()
+    """
+    names, messages = grid
+    for name in names:
+        print(f"Setting {name} pattern...")
+    send_batch(messages)
+
+# The preset grids never change, so their messages are built once at import
+BASIC_BEAT_GRID = grid_messages(BASIC_BEAT_STEPS)
+TRAP_BEAT_GRID = grid_messages(TRAP_BEAT_STEPS)
+HOUSE_BEAT_GRID = grid_messages(HOUSE_BEAT_STEPS)
 
 # Create a simple 4/4 beat pattern
 def create_basic_beat():
@@ -185,32 +262,10 @@ def create_basic_beat():
     create_channel("Hi-Hat")    # Channel 2
     create_channel("Snare")     # Channel 3
     
-    # 5. Create kick pattern (every quarter note)
-    print("Setting kick pattern...")
-    for step in [0, 4, 8, 12]:  # Steps on beats 1, 2, 3, 4
-        set_step(0, step, True, 100)
-        time.sleep(0.2)
-    
-    # 6. Create clap pattern (beats 2 and 4)
-    print("Setting clap pattern...")
-    for step in [4, 12]:  # Steps on beats 2 and 4
-        set_step(1, step, True, 90)
-        time.sleep(0.2)
-    
-    # 7. Create hi-hat pattern (eighth notes)
-    print("Setting hi-hat pattern...")
-    for step in range(0, 16, 2):  # Steps on all eighth notes
-        velocity = 90 if step % 4 == 0 else 70  # Accent on the beat
-        set_step(2, step, True, velocity)
-        time.sleep(0.2)
-    
-    # 8. Create snare pattern (beats 2 and 4)
-    print("Setting snare pattern...")
-    for step in [4, 12]:  # Steps on beats 2 and 4
-        set_step(3, step, True, 95)
-        time.sleep(0.2)
-    
-    # 9. Add pattern to playlist
+    # 5. Set the kick, clap, hi-hat and snare patterns
+    send_grid(BASIC_BEAT_GRID)
+    
+    # 6. Add pattern to playlist
     print("Adding pattern to playlist...")
     time.sleep(0.5)
     send_midi_note(NOTE_ADD_TO_PLAYLIST)
@@ -222,7 +277,7 @@ def create_basic_beat():
     send_midi_cc(12, 0)   # Track 0
     time.sleep(0.5)
     
-    # 10. Play the pattern
+    # 7. Play the pattern
     print("Playing the pattern...")
     send_midi_note(NOTE_PLAY)
     
@@ -253,39 +308,10 @@ def create_trap_beat():
     create_channel("Open Hat")   # Channel 3
     create_channel("808 Bass")   # Channel 4
     
-    # 5. Create 808 kick pattern (trap style with ghost notes)
-    print("Setting 808 kick pattern...")
-    for step, velocity in [(0, 100), (6, 80), (8, 100), (14, 90)]:
-        set_step(0, step, True, velocity)
-        time.sleep(0.2)
-    
-    # 6. Create clap pattern (beats 2 and 4)
-    print("Setting clap pattern...")
-    for step in [4, 12]:
-        set_step(1, step, True, 95)
-        time.sleep(0.2)
-    
-    # 7. Create hi-hat pattern (trap style with rolls)
-    print("Setting hi-hat pattern...")
-    # Simple 16th note pattern with velocity variations
-    velocities = [90, 60, 75, 60, 90, 60, 75, 60, 90, 60, 75, 60, 90, 60, 75, 60]
-    for step, velocity in enumerate(velocities):
-        set_step(2, step, True, velocity)
-        time.sleep(0.2)
-    
-    # 8. Create open hi-hat accents
-    print("Setting open hi-hat pattern...")
-    for step in [2, 10]:
-        set_step(3, step, True, 85)
-        time.sleep(0.2)
-    
-    # 9. Create 808 bass pattern
-    print("Setting 808 bass pattern...")
-    for step, velocity in [(0, 100), (8, 95)]:
-        set_step(4, step, True, velocity)
-        time.sleep(0.2)
-    
-    # 10. Add pattern to playlist
+    # 5. Set the drum and 808 patterns
+    send_grid(TRAP_BEAT_GRID)
+    
+    # 6. Add pattern to playlist
     print("Adding pattern to playlist...")
     time.sleep(0.5)
     send_midi_note(NOTE_ADD_TO_PLAYLIST)
@@ -297,7 +323,7 @@ def create_trap_beat():
     send_midi_cc(12, 0)   # Track 0
     time.sleep(0.5)
     
-    # 11. Play the pattern
+    # 7. Play the pattern
     print("Playing the pattern...")
     send_midi_note(NOTE_PLAY)
     
@@ -328,36 +354,10 @@ def create_house_beat():
     create_channel("Open Hat")   # Channel 3
     create_channel("Bass")       # Channel 4
     
-    # 5. Create four-on-the-floor kick pattern
-    print("Setting kick pattern...")
-    for step in [0, 4, 8, 12]:
-        set_step(0, step, True, 100)
-        time.sleep(0.2)
-    
-    # 6. Create clap/snare on beats 2 and 4
-    print("Setting clap pattern...")
-    for step in [4, 12]:
-        set_step(1, step, True, 90)
-        time.sleep(0.2)
-    
-    # 7. Create closed hi-hat pattern (offbeats)
-    print("Setting closed hi-hat pattern...")
-    for step in [2, 6, 10, 14]:  # Offbeats
-        set_step(2, step, True, 85)
-        time.sleep(0.2)
-    
-    # 8. Create open hi-hat accents
-    print("Setting open hi-hat pattern...")
-    set_step(3, 7, True, 85)  # Single open hat accent
-    time.sleep(0.2)
-    
-    # 9. Create simple bass pattern
-    print("Setting bass pattern...")
-    for step, velocity in [(0, 100), (4, 90), (8, 100), (12, 90)]:
-        set_step(4, step, True, velocity)
-        time.sleep(0.2)
+    # 5. Set the drum and bass patterns
+    send_grid(HOUSE_BEAT_GRID)
     
-    # 10. Add pattern to playlist
+    # 6. Add pattern to playlist
     print("Adding pattern to playlist...")
     time.sleep(0.5)
     send_midi_note(NOTE_ADD_TO_PLAYLIST)
@@ -369,7 +369,7 @@ def create_house_beat():
     send_midi_cc(12, 0)   # Track 0
     time.sleep(0.5)
     
-    # 11. Play the pattern
+    # 7. Play the pattern
     print("Playing the pattern...")
     send_midi_note(NOTE_PLAY)
     
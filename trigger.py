@@ -3,11 +3,54 @@ import httpx
 from mcp.server.fastmcp import FastMCP
 import mido
 from mido import Message
+import asyncio
+import functools
+import logging
+import math
+import re
+import sys
 import time
 
+# stdout carries the MCP stdio protocol, so all status output goes through
+# logging, which writes to stderr
+logger = logging.getLogger(__name__)
+
 # Initialize FastMCP server
 mcp = FastMCP("flstudio")
-output_port = mido.open_output('loopMIDI Port 2') 
+
+# The output port is opened on first use rather than at import, so the
+# server still starts when loopMIDI isn't running yet
+PORT_NAME = 'loopMIDI Port 2'
+_output_port = None
+
+def _port():
+    """Return the output port, opening it if needed"""
+    global _output_port
+    if _output_port is None:
+        _output_port = mido.open_output(PORT_NAME)
+        logger.info(f"Opened MIDI output {PORT_NAME}")
+    return _output_port
+
+def _send(message):
+    """
+    Send a message, reopening the port and retrying once if the send fails
+    (e.g. after loopMIDI was restarted)
+    
+    Args:
+        message (Message): The message to send
+    """
+    global _output_port
+    port = _port()
+    try:
+        port.send(message)
+    except OSError as e:
+        logger.warning(f"Send on {PORT_NAME} failed ({e}), reopening port")
+        try:
+            port.close()
+        except Exception:
+            pass
+        _output_port = None
+        _port().send(message)
 
 # MIDI Note mappings for FL Studio commands
 NOTE_PLAY = 60          # C3
@@ -37,81 +80,187 @@ CLAP = 39      # D#1
 CLOSED_HAT = 42  # F#1
 OPEN_HAT = 46  # A#1
 
+@functools.lru_cache(maxsize=4096)
+def _msg(kind, note, velocity):
+    """
+    Return a shared note message, built once per (kind, note, velocity)
+    
+    Messages are never modified after sending, so one instance can be
+    reused for every send instead of validating a new one each time.
+    
+    Args:
+        kind (str): 'note_on' or 'note_off'
+        note (int): MIDI note number (0-127)
+        velocity (int): Note velocity (0-127)
+    """
+    return Message(kind, note=note, velocity=velocity)
 
+def _off(note):
+    """
+    Return the message that ends a note: a note on with velocity 0
+    
+    MIDI treats this as a note off, and it shares the note on status byte,
+    so drivers that use running status can drop the status byte from it.
+    
+    Args:
+        note (int): MIDI note number (0-127)
+    """
+    return _msg('note_on', note, 0)
+
+
+# Port names are rescanned at most once per PORTS_TTL seconds
+PORTS_TTL = 5.0
+_ports_cache = None  # (time.monotonic() of the scan, port names)
+
+def _get_ports():
+    """Return the MIDI output port names, rescanning once the cache expires"""
+    global _ports_cache
+    now = time.monotonic()
+    if _ports_cache is None or now - _ports_cache[0] >= PORTS_TTL:
+        _ports_cache = (now, tuple(mido.get_output_names()))
+    return _ports_cache[1]
 
 @mcp.tool()
 def list_midi_ports():
     """List all available MIDI input ports"""
-    print("\nAvailable MIDI Input Ports:")
-    input_ports = mido.get_output_names()
+    input_ports = list(_get_ports())
     if not input_ports:
-        print("  No MIDI input ports found")
+        body = "  No MIDI input ports found"
     else:
-        for i, port in enumerate(input_ports):
-            print(f"  {i}: {port}")
+        body = "\n".join(f"  {i}: {port}" for i, port in enumerate(input_ports))
+    # One log record for the whole listing
+    logger.info("Available MIDI Input Ports:\n" + body)
     
     return input_ports
 
 @mcp.tool()
-def play():
+def refresh_midi_ports():
+    """Rescan the system for MIDI ports, e.g. after plugging in a device"""
+    global _ports_cache
+    _ports_cache = None
+    return list_midi_ports()
+
+async def _sleep_until(deadline):
+    """
+    Sleep until the event loop clock reaches deadline, without blocking
+    other tools; returns at once if sending already used up the wait
+    
+    Args:
+        deadline (float): Absolute time on the running loop's clock
+    """
+    remaining = deadline - asyncio.get_running_loop().time()
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
+async def _press(on, off, duration):
+    """
+    Send a note on, hold it for duration seconds, then send the note off
+    
+    Args:
+        on (Message): The note on message
+        off (Message): The matching note off message
+        duration (float): Seconds between note on and note off
+    """
+    deadline = asyncio.get_running_loop().time() + duration
+    _send(on)
+    await _sleep_until(deadline)
+    _send(off)
+
+# Note-off tasks still waiting to run. The event loop only keeps weak
+# references to tasks, so they are held here until they finish
+_pending_offs = set()
+
+async def _send_later(message, delay):
+    """
+    Send a message after delay seconds
+    
+    Args:
+        message (Message): The message to send
+        delay (float): Seconds to wait first
+    """
+    await asyncio.sleep(delay)
+    _send(message)
+
+def _tap(on, off, duration):
+    """
+    Send a note on now and schedule its note off, without waiting for it
+    
+    Must be called from a running event loop; the tool can return while the
+    note off is still pending.
+    
+    Args:
+        on (Message): The note on message
+        off (Message): The matching note off message
+        duration (float): Seconds between note on and note off
+    """
+    _send(on)
+    task = asyncio.get_running_loop().create_task(_send_later(off, duration))
+    _pending_offs.add(task)
+    task.add_done_callback(_pending_offs.discard)
+
+# Transport commands never change, so their messages are built at import.
+# Each entry is (note on, note off, log line)
+_TRIGGERS = {
+    'play': (_msg('note_on', NOTE_PLAY, 100), _off(NOTE_PLAY), "Sent Play command"),
+    'stop': (_msg('note_on', NOTE_STOP, 100), _off(NOTE_STOP), "Sent Stop command"),
+}
+
+def _trigger(name):
+    """
+    Tap the note for a transport command
+    
+    Args:
+        name (str): Key in _TRIGGERS
+    """
+    on, off, message = _TRIGGERS[name]
+    _tap(on, off, 0.1)
+    logger.info(message)
+
+@mcp.tool()
+async def play():
     """Send MIDI message to start playback in FL Studio"""
-    # Send Note On for C3 (note 60)
-    output_port.send(mido.Message('note_on', note=60, velocity=100))
-    time.sleep(0.1)  # Small delay
-    output_port.send(mido.Message('note_off', note=60, velocity=0))
-    print("Sent Play command")
+    _trigger('play')
 
 @mcp.tool()
-def stop():
+async def stop():
     """Send MIDI message to stop playback in FL Studio"""
-    # Send Note On for C#3 (note 61)
-    output_port.send(mido.Message('note_on', note=61, velocity=100))
-    time.sleep(0.1)  # Small delay
-    output_port.send(mido.Message('note_off', note=61, velocity=0))
-    print("Sent Stop command")
+    _trigger('stop')
+
+# Bit offsets of each 7-bit MIDI byte, most significant first (covers 28 bits)
+_SHIFTS = (21, 14, 7, 0)
 
 def int_to_midi_bytes(value):
     """
     Convert an integer value into an array of MIDI-compatible bytes (7-bit values)
     
     Args:
-        value (int): The integer value to convert
+        value (int): The integer value to convert (0 to 2**28 - 1)
         
     Returns:
         list: Array of MIDI bytes (each 0-127)
     """
     if value < 0:
-        print("Warning: Negative values not supported, converting to positive")
+        logger.warning("Negative values not supported, converting to positive")
         value = abs(value)
     
-    # Special case for zero
-    if value == 0:
-        return [0]
-    
-    # Convert to MIDI bytes (7-bit values, MSB first)
-    midi_bytes = []
-    while value > 0:
-        # Extract the lowest 7 bits and prepend to array
-        midi_bytes.insert(0, value & 0x7F)  # 0x7F = 127 (binary: 01111111)
-        # Shift right by 7 bits
-        value >>= 7
-    
-    return midi_bytes
+    # Slice out each 7-bit group MSB first, skipping leading zero groups;
+    # zero itself still needs one byte
+    return [(value >> shift) & 0x7F for shift in _SHIFTS if value >> shift] or [0]
 
-def change_tempo(bpm):
+async def change_tempo(bpm):
     """
     Change the tempo in FL Studio using a sequence of MIDI notes
     
     This function converts a BPM value to an array of MIDI notes,
-    sends a start marker, the notes, and an end marker to trigger
-    a tempo change in FL Studio.
+    sends a start marker, the number of notes, the notes, and an end marker
+    to trigger a tempo change in FL Studio.
     
     Args:
         bpm (float): The desired tempo in beats per minute
     """
     # Ensure BPM is within a reasonable range
     if bpm < 20 or bpm > 999:
-        print(f"Warning: BPM value {bpm} is outside normal range (20-999)")
+        logger.warning(f"BPM value {bpm} is outside normal range (20-999)")
         bpm = max(20, min(bpm, 999))
     
     # Convert BPM to integer
@@ -120,22 +269,36 @@ def change_tempo(bpm):
     # Convert to MIDI bytes
     midi_notes = int_to_midi_bytes(bpm_int)
     
-    print(f"Setting tempo to {bpm_int} BPM using note array: {midi_notes}")
+    logger.info(f"Setting tempo to {bpm_int} BPM using note array: {midi_notes}")
     
     # Send start marker (note 72)
-    send_midi_note(72)
-    time.sleep(0.2)
+    await send_midi_note(72)
+    await asyncio.sleep(0.2)
+    
+    # Send the digit count, so FL Studio can tell digits that happen to be
+    # 72 or 73 from the markers
+    await send_midi_note(len(midi_notes))
+    await asyncio.sleep(0.1)
     
     # Send each note in the array
     for note in midi_notes:
-        send_midi_note(note)
-        time.sleep(0.1)
+        await send_midi_note(note)
+        await asyncio.sleep(0.1)
     
     # Send end marker (note 73)
-    send_midi_note(73)
-    time.sleep(0.2)
+    await send_midi_note(73)
+    await asyncio.sleep(0.2)
     
-    print(f"Tempo change to {bpm_int} BPM sent successfully using {len(midi_notes)} notes")
+    logger.info(f"Tempo change to {bpm_int} BPM sent successfully using {len(midi_notes)} notes")
+
+def _clip127(value):
+    """Clamp an int to the 0-127 MIDI data range"""
+    return 0 if value < 0 else 127 if value > 127 else value
+
+# One melody line: "note,velocity,length,position", with optional spaces
+# around the fields; length and position may have a decimal part
+_NUMBER = r'\s*(-?\d+(?:\.\d*)?|-?\.\d+)\s*'
+_NOTE_LINE = re.compile(r'\s*(-?\d+)\s*,\s*(-?\d+)\s*,' + _NUMBER + ',' + _NUMBER).fullmatch
 
 @mcp.tool()
 def send_melody(notes_data):
@@ -146,90 +309,145 @@ def send_melody(notes_data):
         notes_data (str): String containing note data in format "note,velocity,length,position"
                          with each note on a new line
     """
-    # Parse the notes_data string into a list of note tuples
-    notes = []
+    # Parse each line and pack it straight into the MIDI data array
+    # (6 values per note), without building an intermediate note list
+    midi_data = []
+    # Local bindings for the per-line calls
+    extend, parse, modf = midi_data.extend, _NOTE_LINE, math.modf
     for line in notes_data.strip().split('\n'):
-        if not line.strip():
-            continue
-            
-        parts = line.strip().split(',')
-        if len(parts) != 4:
-            print(f"Warning: Skipping invalid line: {line}")
-            continue
-            
-        try:
-            note = min(127, max(0, int(parts[0])))
-            velocity = min(127, max(0, int(parts[1])))
-            length = max(0, float(parts[2]))
-            position = max(0, float(parts[3]))
-            notes.append((note, velocity, length, position))
-        except ValueError:
-            print(f"Warning: Skipping line with invalid values: {line}")
+        line = line.strip()
+        if not line:
             continue
-    
-    if not notes:
-        return "No valid notes found in input data"
-    
-    # Create the MIDI data array (5 values per note)
-    midi_data = []
-    for note, velocity, length, position in notes:
-        # 1. Note value (0-127)
-        midi_data.append(note)
-        
-        # 2. Velocity value (0-127)
-        midi_data.append(velocity)
         
-        # 3. Length whole part (0-127)
-        length_whole = min(127, int(length))
-        midi_data.append(length_whole)
-        
-        # 4. Length decimal part (0-9)
-        length_decimal = int(round((length - length_whole) * 10)) % 10
-        midi_data.append(length_decimal)
+        # A single regex match both validates the line and splits it, so
+        # the fields below can be converted without a try/except
+        match = parse(line)
+        if match is None:
+            logger.warning(f"Skipping invalid line: {line}")
+            continue
         
-        # 5. Position whole part (0-127)
-        position_whole = min(127, int(position))
-        midi_data.append(position_whole)
+        note, velocity, length, position = match.groups()
+        note = _clip127(int(note))
+        velocity = _clip127(int(velocity))
+        length = max(0, float(length))
+        position = max(0, float(position))
         
-        # 6. Position decimal part (0-9)
-        position_decimal = int(round((position - position_whole) * 10)) % 10
-        midi_data.append(position_decimal)
+        # Whole parts are capped at 127, decimal parts are 0-9; modf splits
+        # each value into (fraction, whole) in one call
+        length_fraction, length_whole = modf(length)
+        position_fraction, position_whole = modf(position)
+        extend((
+            note,
+            velocity,
+            min(127, int(length_whole)),
+            int(round(length_fraction * 10)) % 10,
+            min(127, int(position_whole)),
+            int(round(position_fraction * 10)) % 10,
+        ))
+    
+    if not midi_data:
+        return "No valid notes found in input data"
+    note_count = len(midi_data) // 6
     
     # Start MIDI transfer
-    print(f"Transferring {len(notes)} notes ({len(midi_data)} MIDI values)...")
+    logger.info(f"Transferring {note_count} notes ({len(midi_data)} MIDI values)...")
     
+    # FL Studio reads the values in arrival order, so they go out without
+    # any pacing between them
     # Initial toggle signal (note 0)
-    send_midi_note(0)
-    time.sleep(0.01)
+    send_midi_note_fast(0)
     
     # Send total count of notes
-    send_midi_note(min(127, len(notes)))
-    time.sleep(0.01)
+    send_midi_note_fast(min(127, note_count))
     
     # Send all MIDI data values
-    for i, value in enumerate(midi_data):
-        send_midi_note(value)
-        #time.sleep(0.1)
-        #print(f"Sent MIDI value {i+1}/{len(midi_data)}: {value}")
+    for value in midi_data:
+        send_midi_note_fast(value)
     
-    send_midi_note(127)
+    send_midi_note_fast(127)
+
+    #print(f"Melody transfer complete: {note_count} notes sent")
+    return f"Melody successfully transferred: {note_count} notes ({len(midi_data)} MIDI values) sent to FL Studio"
 
-    #print(f"Melody transfer complete: {len(notes)} notes sent")
-    return f"Melody successfully transferred: {len(notes)} notes ({len(midi_data)} MIDI values) sent to FL Studio"
+# SysEx step rows: F0, SYSEX_ID, channel, the 16-step mask as 2+7+7 bits,
+# one velocity per step, F7. Decoded by OnSysEx in device_test.py
+SYSEX_ID = 0x7D  # Manufacturer ID reserved for non-commercial use
+
+@mcp.tool()
+def send_steps(channel, mask, velocities=None):
+    """
+    Set all 16 steps of a channel rack row with a single SysEx message
+    
+    Args:
+        channel (int): Channel index (0-127)
+        mask (int): 16-bit step mask, bit n turns step n on
+        velocities (list): Velocity for each step (0-127), 100 where missing
+    """
+    velocities = [_clip127(int(v)) for v in (velocities or ())[:16]]
+    velocities += [100] * (16 - len(velocities))
+    mask &= 0xFFFF
+    _send(Message('sysex', data=[
+        SYSEX_ID, channel & 0x7F, mask >> 14, (mask >> 7) & 0x7F, mask & 0x7F,
+        *velocities,
+    ]))
+    return f"Set {bin(mask).count('1')} of 16 steps on channel {channel}"
+
+@mcp.tool()
+async def play_sequence(notes, gap_ms=100, velocity=100):
+    """
+    Play a run of notes, one every gap_ms milliseconds
+    
+    Each note is held until the next one starts. The schedule is kept
+    against absolute deadlines, so slow sends don't make it drift.
+    
+    Args:
+        notes (list): MIDI note numbers (0-127)
+        gap_ms (int): Milliseconds from one note on to the next
+        velocity (int): Velocity for every note (0-127)
+    """
+    velocity = _clip127(int(velocity))
+    pairs = [(_msg('note_on', note, velocity), _off(note))
+             for note in (_clip127(int(n)) for n in notes)]
+    if not pairs:
+        return "No notes to play"
+    
+    gap = max(0, gap_ms) / 1000
+    start = asyncio.get_running_loop().time()
+    off = None
+    for i, (on, next_off) in enumerate(pairs):
+        await _sleep_until(start + i * gap)
+        if off is not None:
+            _send(off)
+        _send(on)
+        off = next_off
+    await _sleep_until(start + len(pairs) * gap)
+    _send(off)
+    return f"Played {len(pairs)} notes"
 
 # Send a MIDI note message
 @mcp.tool()
-def send_midi_note(note, velocity=1, duration=0.01):
+async def send_midi_note(note, velocity=1, duration=0.01):
     """Send a MIDI note on/off message with specified duration"""
-    note_on = Message('note_on', note=note, velocity=velocity)
-    output_port.send(note_on)
     #print(f"Sent MIDI note {note} (on), velocity {velocity}")
-    time.sleep(duration)
-    note_off = Message('note_off', note=note, velocity=0)
-    output_port.send(note_off)
-    print(f"Sent MIDI note {note} (off)")
+    await _press(_msg('note_on', note, velocity), _off(note), duration)
+    logger.info(f"Sent MIDI note {note} (off)")
     #time.sleep(0.1)  # Small pause between messages
+
+def send_midi_note_fast(note, velocity=1):
+    """
+    Send a MIDI note on/off pair with no pause and no logging
+    
+    Used for bulk transfers where the receiver only needs the values in
+    order; send_midi_note keeps the timed version for single commands.
+    
+    Args:
+        note (int): MIDI note number (0-127)
+        velocity (int): Note velocity (0-127)
+    """
+    _send(_msg('note_on', note, velocity))
+    _send(_off(note))
     
 if __name__ == "__main__":
     # Initialize and run the server
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
     mcp.run(transport='stdio')
\ No newline at end of file